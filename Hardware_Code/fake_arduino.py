@@ -0,0 +1,194 @@
+"""
+Stand-in for the steerbox Arduino on a Linux pseudo-terminal, for profiling the real-time loop without the hardware.
+
+It runs the main loop of arduino_code.c: every 20 ms send the "<hBB" status, wait up to 50 ms
+for a 1 byte command, report how long the command took (or the powerup/timeout errors).
+As on the hardware an error locks the motor out: it stays off and every status repeats the
+error until a 0x80 command acknowledges it. locked_cycles counts the cycles spent like that.
+The wheel is moved by the Simulation (nearest recorded transition) instead of the motor.
+Latency (plus jitter) delays every status, quadrature errors are added at random.
+
+Start it and point Steerbox at the printed port:
+    python Hardware_Code/fake_arduino.py --latency_ms 2 --jitter_ms 1
+    box = Steerbox(port="/dev/pts/N")
+
+Or drive it with a random policy through Steerbox and print the round trip histogram:
+    python Hardware_Code/fake_arduino.py --drive 500 --compute_ms 5
+"""
+import os
+import sys
+import tty
+import time
+import random
+import select
+import struct
+import argparse
+import threading
+import numpy as np
+
+# the simulation lives in the repository root, steer.py next to this file
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from Vehicle_Env import Simulation
+
+COUNTS_PER_CIRCLE = 4*2802
+
+class FakeArduino:
+    def __init__(self, sim, latency_ms=0.0, jitter_ms=0.0, quadrature_error_rate=0.0, period_ms=20, timeout_ms=50, seed=None):
+        self.sim = sim
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.quadrature_error_rate = quadrature_error_rate
+        self.period_ms = period_ms
+        self.timeout_ms = timeout_ms
+        self.rng = random.Random(seed)
+
+        # wheel state as the simulation sees it: (position, velocity, applied voltage)
+        self.state = np.zeros(3)
+        self.q_err = 0
+        self.last_error = 1 # just powered on error
+        self.last_speed_cmd = 0
+        self.last_time_ms = 0
+        self.locked_cycles = 0 # cycles the motor was held off by an unacknowledged error
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="fake-arduino", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def read_command(self, deadline):
+        """
+        One command byte, or None if nothing arrived before deadline (perf_counter seconds)
+        """
+        while self.running:
+            wait = deadline - time.perf_counter() if deadline is not None else 0.1
+            if deadline is not None and wait <= 0:
+                return None
+            ready, _, _ = select.select([self.master], [], [], max(0.0, min(wait, 0.1)))
+            if ready:
+                return os.read(self.master, 1)[0]
+        return None
+
+    def apply(self, cmd):
+        """
+        Move the wheel for one period with the commanded speed
+        """
+        voltage = (cmd & 0x7F) / 127 * (-1 if cmd & 0x80 else 1)
+        if self.last_error:
+            self.locked_cycles += 1
+        if self.last_error or voltage == 0:
+            # motor off: the wheel stops where it is
+            self.state = np.array([self.state[0], 0.0, 0.0])
+            return
+        # voltage going up (or held positive) is action 1, as in SteerboxEnv
+        action = 1 if voltage > self.state[2] or (voltage == self.state[2] and voltage > 0) else 0
+        pos, vel, _ = self.sim.query(self.state, action)
+        if pos == self.state[0] and vel == self.state[1]:
+            # with a held voltage the nearest recorded transition can be the state itself,
+            # keep the wheel moving with its velocity instead of freezing it
+            pos = pos + vel
+        self.state = np.array([pos, vel, voltage])
+
+    def status(self):
+        if self.rng.random() < self.quadrature_error_rate:
+            self.q_err = (self.q_err + 1) & 0xFF
+        q_val = int(np.clip(round(self.state[0] * COUNTS_PER_CIRCLE), -32768, 32767))
+        flags = (self.last_error | 0x80) if self.last_error else min(self.last_time_ms, 0xFF)
+        return struct.pack("<hBB", q_val, self.q_err, flags)
+
+    def run(self):
+        while self.running:
+            cycle_start = time.perf_counter()
+            # the command takes effect at the top of the loop, the motor is off while an error
+            # is not acknowledged (apply)
+            self.apply(self.last_speed_cmd)
+            if self.last_speed_cmd == 0x80: # acknowledge error
+                self.last_error = 0
+
+            delay = self.latency_ms + (self.rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+            if delay > 0:
+                time.sleep(delay / 1e3)
+            os.write(self.master, self.status())
+
+            cmd = self.read_command(cycle_start + self.timeout_ms / 1e3)
+            if cmd is not None:
+                self.last_speed_cmd = cmd
+                self.last_time_ms = int(1e3 * (time.perf_counter() - cycle_start))
+                # keep the 50 Hz rhythm
+                remaining = cycle_start + self.period_ms / 1e3 - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+            else:
+                # timed out
+                if not self.last_error:
+                    self.last_error = 2
+                self.last_time_ms = 0xFF
+                self.state = np.array([self.state[0], 0.0, 0.0])
+                # stay in sync: wait for a command and ignore it, it is based on outdated information
+                self.read_command(None)
+                self.last_speed_cmd = 0
+
+def drive(port, steps, compute_ms=0.0, seed=0, arduino=None):
+    """
+    Control loop with a random policy against the port, with compute_ms of work per step (e.g. the network)
+    Deadline misses are recorded instead of raised.
+    """
+    from steer import Steerbox, SteerboxEnv, RoundTripStats
+
+    random.seed(seed)
+    box = Steerbox(port=port, strict=False)
+    box.interact(0, reset=True, allow_powerup=True) # first contact after (fake) power up
+    env = SteerboxEnv(box)
+    env.reset()
+    box.stats = RoundTripStats() # only the control loop
+    for _ in range(steps):
+        if compute_ms:
+            time.sleep(compute_ms / 1e3)
+        env.step(random.randint(0, 1))
+    box.interact(0, reset=True)
+    box.stats.print_histogram()
+    if arduino is not None:
+        print(f"\tcycles with the motor locked out by an error: {arduino.locked_cycles}")
+    box.close()
+    return box.stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default='./Hardware_Data', help="Directory with hardware data to build the simulation")
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="Delay of every status packet")
+    parser.add_argument("--jitter_ms", type=float, default=0.0, help="Uniform +- jitter on the delay")
+    parser.add_argument("--quadrature_error_rate", type=float, default=0.0, help="Probability of a quadrature error per status")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for jitter and quadrature errors")
+    parser.add_argument("--drive", type=int, default=0, help="Run this many steps of a random policy against the stand-in and exit")
+    parser.add_argument("--compute_ms", type=float, default=0.0, help="With --drive, time spent per step before sending the command")
+    args = parser.parse_args()
+
+    sim = Simulation()
+    sim.build(args.data_dir)
+    arduino = FakeArduino(sim, args.latency_ms, args.jitter_ms, args.quadrature_error_rate, seed=args.seed).start()
+    print(f"Fake arduino listening on {arduino.port}")
+
+    try:
+        if args.drive:
+            drive(arduino.port, args.drive, args.compute_ms, seed=args.seed or 0, arduino=arduino)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        arduino.stop()
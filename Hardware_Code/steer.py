@@ -1,52 +1,247 @@
+import os
+import time
+import queue
+import struct
+import random
+import threading
+import serial
+import numpy as np
+from collections import namedtuple
+
 # STEERBOX LOGIC
 # handles communicating with the Arduino
 
 # THE PROTOCOL
-# to be documented
+# every 20 ms the arduino sends a 4 byte status "<hBB":
+#   position (encoder counts, 4*2802 per circle), quadrature error count,
+#   ms it took to receive the last command, or an error flag (0x80 | error)
+#   errors: 1 = just powered up, 2 = no command within 50 ms
+# and waits for a 1 byte command: bit 7 = direction, bits 0-6 = speed (0-127)
+# 0x80 acknowledges an error. see arduino_code.c, and fake_arduino.py for a stand-in
+
+class RoundTripStats:
+    """
+    Histogram of the round trip reported by the hardware (status sent -> command received, 1 ms bins)
+    and of the cycle between the statuses the host answered, with deadline misses
+    """
+    def __init__(self, deadline_ms=20, max_ms=50):
+        self.deadline_ms = deadline_ms
+        self.round_trip = np.zeros(max_ms + 2, dtype=np.int64) # last bin: over max_ms
+        self.cycle = np.zeros(max_ms + 2, dtype=np.int64)
+        self.misses = 0
+        self.timeouts = 0
+        self.last_read = None
+
+    def record(self, last_time_ms, now=None):
+        # now: when the status arrived
+        if now is None:
+            now = time.perf_counter()
+        if self.last_read is not None:
+            cycle_ms = 1e3 * (now - self.last_read)
+            self.cycle[min(int(cycle_ms), len(self.cycle) - 1)] += 1
+        self.last_read = now
+
+        if last_time_ms == 0x82:
+            self.timeouts += 1
+            self.misses += 1
+        elif not last_time_ms & 0x80:
+            self.round_trip[min(last_time_ms, len(self.round_trip) - 1)] += 1
+            if last_time_ms >= self.deadline_ms:
+                self.misses += 1
+
+    def reset_cycle(self):
+        # resets and waits are not part of the control loop
+        self.last_read = None
+
+    def percentile(self, histogram, q):
+        counts = np.cumsum(histogram)
+        if counts[-1] == 0:
+            return float("nan")
+        return float(np.searchsorted(counts, q / 100 * counts[-1]))
+
+    def summary(self):
+        return {
+            "interactions": int(self.round_trip.sum()) + self.timeouts,
+            "round_trip_p50_ms": self.percentile(self.round_trip, 50),
+            "round_trip_p99_ms": self.percentile(self.round_trip, 99),
+            "cycle_p50_ms": self.percentile(self.cycle, 50),
+            "cycle_p99_ms": self.percentile(self.cycle, 99),
+            "deadline_misses": self.misses,
+            "timeouts": self.timeouts,
+        }
+
+    def print_histogram(self):
+        print(f"round trip (hardware reported), deadline {self.deadline_ms} ms:")
+        for ms, count in enumerate(self.round_trip):
+            if count:
+                label = f">{ms - 1}" if ms == len(self.round_trip) - 1 else str(ms)
+                print(f"\t{label:>4s} ms {count:8d} " + "#" * int(50 * count / self.round_trip.max()))
+        print("\t" + ", ".join(f"{k}: {v}" for k, v in self.summary().items()))
+
+# a status as received by SerialIO: sequence number, host arrival time (perf_counter) and the
+# "<hBB" fields
+Frame = namedtuple('Frame', ["seq", "time", "pos", "q_err", "flags"])
+FRAME_DTYPE = np.dtype([("seq", np.int64), ("time", np.float64),
+                        ("pos", np.int16), ("q_err", np.uint8), ("flags", np.uint8)])
+
+class SerialIO:
+    """
+    Background threads on the serial port: one reads the status stream into a ring buffer of
+    timestamped frames, one writes the commands put on a queue, so the controller never waits on
+    the wire for anything but the next status.
+    The statuses carry no start marker, frames are aligned on the pause between statuses: bytes of
+    an incomplete frame left from before a pause (the port opened mid-status) are dropped.
+    """
+    def __init__(self, ser, capacity=256, gap_s=0.01):
+        self.ser = ser
+        self.gap_s = gap_s
+        self.frames = np.zeros(capacity, dtype=FRAME_DTYPE)
+        self.count = 0 # frames received, the newest is frames[(count-1) % capacity]
+        self.dropped_bytes = 0
+        self.error = None
+
+        self.arrived = threading.Condition()
+        self.commands = queue.SimpleQueue()
+        self.running = True
+        self.reader = threading.Thread(target=self.read_loop, name="steerbox-read", daemon=True)
+        self.writer = threading.Thread(target=self.write_loop, name="steerbox-write", daemon=True)
+        self.reader.start()
+        self.writer.start()
+
+    def read_loop(self):
+        pending = bytearray()
+        last = 0.0
+        try:
+            while self.running:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+                if not data:
+                    continue
+                now = time.perf_counter()
+                if pending and now - last > self.gap_s:
+                    self.dropped_bytes += len(pending)
+                    pending.clear()
+                last = now
+                pending += data
+
+                n = len(pending) // 4
+                if n:
+                    for pos, q_err, flags in struct.iter_unpack("<hBB", pending[:4*n]):
+                        self.frames[self.count % len(self.frames)] = (self.count, now, pos, q_err, flags)
+                        # publish only after the frame is written
+                        self.count += 1
+                    del pending[:4*n]
+                    with self.arrived:
+                        self.arrived.notify_all()
+        except (serial.SerialException, OSError) as e:
+            if self.running:
+                self.error = e
+                with self.arrived:
+                    self.arrived.notify_all()
+
+    def write_loop(self):
+        while True:
+            data = self.commands.get()
+            if data is None:
+                return
+            self.ser.write(data)
+
+    def send(self, data):
+        self.commands.put(data)
+
+    def latest(self):
+        count = self.count
+        if count == 0:
+            return None
+        return Frame._make(self.frames[(count-1) % len(self.frames)].item())
+
+    def wait_frame(self, after, timeout):
+        """
+        The freshest frame with a sequence number above after, waiting up to timeout seconds for
+        one to arrive. None if none did
+        """
+        if self.count <= after + 1:
+            with self.arrived:
+                self.arrived.wait_for(lambda: self.count > after + 1 or self.error is not None, timeout)
+        if self.error is not None:
+            raise self.error
+        if self.count <= after + 1:
+            return None
+        return self.latest()
+
+    def close(self):
+        self.running = False
+        self.commands.put(None)
+        self.writer.join()
+        self.reader.join()
 
 class Steerbox:
-    def __init__(self):
+    def __init__(self, port=None, strict=True):
         self.curr_voltage = None
+        # strict: raise on a late round trip, otherwise only count it as a deadline miss
+        # (a timeout is then acknowledged, the hardware keeps the motor off until it is)
+        self.strict = strict
+        self.stats = RoundTripStats()
 
         # search for the serial port the arduino is connected to
-        for f in os.listdir("/dev"):
-            if f.startswith("ttyUSB") or f.startswith("tty.usbserial"):
-                p = "/dev/"+f
-                break
-        else:
-            raise Exception("could not find arduino!")
+        if port is None:
+            for f in os.listdir("/dev"):
+                if f.startswith("ttyUSB") or f.startswith("tty.usbserial"):
+                    port = "/dev/"+f
+                    break
+            else:
+                raise Exception("could not find arduino!")
         # open the serial port
-        # reads time out after half a second
-        self.ser = serial.Serial(p, baudrate=115200, timeout=0.5)
-    
+        # the reader thread polls, reads time out after 50 ms so it notices close()
+        self.ser = serial.Serial(port, baudrate=115200, timeout=0.05)
+        self.io = SerialIO(self.ser)
+        self.answered = -1 # sequence number of the last status a command was sent for
+
+    def reset_comms(self, allow_powerup=False):
+        # bring the arduino out of its error state without waiting for it to time out:
+        # acknowledge (0x80, also speed 0) every status until one without an error comes back
+        # for a command we sent. that status is left for interact to answer
+        sent = False
+        checked_powerup = allow_powerup
+        for _ in range(10):
+            frame = self.io.wait_frame(self.answered, 0.06)
+            if frame is None:
+                # timed out, it waits for one byte (and ignores it) before the next status
+                self.io.send(b'\x00')
+                sent = True
+                continue
+            if not checked_powerup and frame.flags == 0x81:
+                # maybe it got unplugged accidentally?
+                raise Exception("hardware unexpectedly just powered up!")
+            checked_powerup = True
+            if sent and not frame.flags & 0x80:
+                return frame
+            self.io.send(b'\x80')
+            self.answered = frame.seq
+            sent = True
+        raise Exception("hardware did not respond to the reset!")
+
     def interact(self, voltage, dv=None, reset=False, allow_powerup=False):
         # receive the wheel's current position, then send a voltage
         # returns the position and the sent voltage
         # dv controls how much the voltage is allowed to change this interaction
 
         if reset: # reset the arduino communications
-            # tell hardware to stop a bunch
-            self.ser.write(b'\x00\x00\x00\x00')
-            # clear anything out of the serial receive buffer
-            time.sleep(0.1) # ensure hardware times out
-            self.ser.reset_input_buffer()
-
-            # tell it to stop again now that we know it's alive
-            self.ser.write(b'\x00\x00')
-
-            # wait for the updated status
-            _, _, error = struct.unpack("<hBB", self.ser.read(4))
-            if error == 0x81 and not allow_powerup:
-                # maybe it got unplugged accidentally?
-                raise Exception("hardware unexpectedly just powered up!")
-            # acknowledge the error
-            self.ser.write(b'\x80\x00')
-            self.ser.read(4)
-
+            self.reset_comms(allow_powerup)
             self.curr_voltage = 0
-
-        this_pos, last_quadrature_errors, last_time_ms = \
-            struct.unpack("<hBB", self.ser.read(4))
+            self.stats.reset_cycle()
+
+        # the freshest status not answered yet, usually already in the ring buffer
+        frame = self.io.wait_frame(self.answered, 0.5)
+        if frame is None:
+            raise Exception("no status from the hardware!")
+        self.stats.record(frame.flags, frame.time)
+        if frame.flags == 0x82 and not self.strict:
+            # counted as a miss above. the motor stays off and every status repeats the
+            # timeout until it is acknowledged, so acknowledge it and go on from the next status
+            frame = self.reset_comms()
+            self.curr_voltage = 0
+            self.stats.reset_cycle()
+        this_pos, last_quadrature_errors, last_time_ms = frame.pos, frame.q_err, frame.flags
         
         if last_time_ms == 0x81:
             # maybe it got unplugged accidentally?
@@ -61,7 +256,7 @@ class Steerbox:
             # startup and represents an inaccuracy of 1/11208th of a circle. not
             # a big deal.
             raise Exception("quadrature mis-step!")
-        elif last_time_ms >= 20:
+        elif last_time_ms >= 20 and self.strict:
             # we did not get a response out to the hardware in time
             raise Exception("Communication ran behind, took {} ms!".format(
                 last_time_ms))
@@ -71,7 +266,7 @@ class Steerbox:
 
         # wheel is rotated too much, stop the experiment before damage
         if abs(this_pos) > 1.1:
-            self.ser.write(b'\x00\x00\x00\x00')
+            self.io.send(b'\x00\x00\x00\x00')
             raise Exception("Position is too large!")
 
         voltage = min(1, max(-1, float(voltage)))
@@ -89,11 +284,26 @@ class Steerbox:
             cmd = int(self.curr_voltage*127)
         else:
             cmd = 128 + int(-self.curr_voltage*127)
-        self.ser.write(bytes([cmd]))
+        self.io.send(bytes([cmd]))
+        self.answered = frame.seq
 
         return this_pos, self.curr_voltage
+
+    def settle(self, still_statuses=5, max_wait=0.5):
+        # stop the motor and keep communicating until the wheel stands still (same position for
+        # still_statuses statuses), instead of sleeping and letting the hardware time out
+        # returns the position
+        pos, _ = self.interact(0)
+        still = 0
+        deadline = time.perf_counter() + max_wait
+        while still < still_statuses and time.perf_counter() < deadline:
+            last = pos
+            pos, _ = self.interact(0)
+            still = still + 1 if pos == last else 0
+        return pos
     
     def close(self):
+        self.io.close()
         self.ser.close()
         self.curr_voltage = None
 
@@ -123,9 +333,7 @@ class SteerboxEnv:
 
         # stop the wheel and wait for it to have no velocity
         box.interact(0, reset=True)
-        time.sleep(0.5)
-        box.interact(0, reset=True)
-        pos = ppos = box.interact(0)[0]
+        pos = ppos = box.settle()
 
         # (approximately) rotate wheel to random initial position. fortunately
         # the inaccuracy just adds to the randomness!
@@ -137,11 +345,8 @@ class SteerboxEnv:
             while pos < goal-0.1:
                 pos, _ = box.interact(0.7, dv=0.05)
 
-        # stop the wheel again
-        box.interact(0, reset=True)
-        time.sleep(0.5)
-        # get current position
-        pos, _ = box.interact(0, reset=True)
+        # stop the wheel again and get the current position
+        pos = box.settle()
         print("goal:", ppos, "->", goal, "~", pos)
 
         # and initialize the current state
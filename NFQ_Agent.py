@@ -1,6 +1,7 @@
 """
 Defines the Agent
 """
+import time
 import torch 
 import random
 import torch.optim as optim
@@ -8,6 +9,8 @@ import torch.nn as nn
 import numpy as np 
 
 from NFQ_model import NFQNetwork
+from Replay_Store import ReplayStore
+from Utils.numpy_policy import NumpyQNetwork
 
 class NFQAgent:
     def __init__(self, args):
@@ -15,52 +18,99 @@ class NFQAgent:
         self.args = args
         self.net = NFQNetwork(self.args.num_params) 
         self.optimizer = optim.Rprop(self.net.parameters()) # Rprop is the default for NFQ
-        
+
+        # Preallocated network input for action selection, rows are (*state, 0) and (*state, 1)
+        # action_input_np shares its memory, so the state is written without creating tensors
+        self.action_input = torch.zeros(2, 4)
+        self.action_input[1, 3] = 1
+        self.action_input_np = self.action_input.numpy()
+
+        # Optional pure NumPy evaluator, kept in sync with the network after every train()
+        self.numpy_net = None
+        if getattr(self.args, "numpy_policy", False):
+            self.sync_numpy_policy()
+
+    def sync_numpy_policy(self):
+        self.numpy_net = NumpyQNetwork.from_state_dict(self.net.state_dict())
+
+    def load_state(self, state_dict):
+        """
+        Load network weights (tensors or numpy arrays, e.g. published by another process)
+        """
+        self.net.load_state_dict({k: torch.as_tensor(v) for k, v in state_dict.items()})
+        if self.numpy_net is not None:
+            self.sync_numpy_policy()
+
     def get_best_action(self, state):
         """
-        Make copies of the network and evaluate Q-value for each (state, action) combination
+        Evaluate Q-value for each (state, action) combination in one forward pass
         Our controller is Bang-bang, can apply either 0 (0V) or 1 (5V)
         """
-        # state, action= 0
-        q_left = self.net(torch.cat([torch.FloatTensor(state), torch.FloatTensor([0])], dim=0))
+        if self.numpy_net is not None:
+            return self.numpy_net.best_action(state)
+
+        # (state, action= 0) and (state, action= 1)
+        self.action_input_np[:, :3] = state
+        with torch.inference_mode():
+            q = self.net(self.action_input)
 
-        # state, action= 1
-        q_right = self.net(torch.cat([torch.FloatTensor(state), torch.FloatTensor([1])], dim=0))
-        
         # ...
-        # Add more if more actions
+        # Add more if more actions (more rows)
         # ...
 
         # Lower Q value is better, return that
-        return 1 if q_left >= q_right else 0
+        return 1 if q[0, 0] >= q[1, 0] else 0
+
+    def get_best_actions(self, states):
+        """
+        Batched get_best_action for an (N, 3) array of states, returns N actions.
+        Both actions are evaluated in a single forward pass.
+        """
+        if self.numpy_net is not None:
+            return self.numpy_net.best_actions(states)
+
+        n = len(states)
+        state_action_b = torch.zeros(2 * n, 4)
+        state_action_b[:n, :3] = torch.as_tensor(states, dtype=torch.float32)
+        state_action_b[n:, :3] = state_action_b[:n, :3]
+        state_action_b[n:, 3] = 1
 
-    def generate_pattern_set(self, experiences):
+        with torch.inference_mode():
+            q = self.net(state_action_b).squeeze(1)
+
+        # Same tie-breaking as get_best_action
+        return (q[:n] >= q[n:]).long().numpy()
+
+    def generate_pattern_set(self, experiences, indices=None):
         """
         Pattern set = supervised dataset from transitions
+        experiences is a ReplayStore, or a list of (state, action, cost, next_state, done) tuples
+        indices (e.g. from PatternSetSampler) restricts it to those transitions
         """
+        if not isinstance(experiences, ReplayStore):
+            store = ReplayStore(capacity=max(1, len(experiences)))
+            store.extend(experiences)
+            experiences = store
+
+        # b means batch, all views into the replay store
+        state_action_b = experiences.state_action
+        next_state_action_b = experiences.next_state_action
+        cost_b = experiences.cost
+        done_b = experiences.done
+        if indices is not None:
+            # Copies of the selected rows only
+            state_action_b = state_action_b[indices]
+            next_state_action_b = next_state_action_b[indices]
+            cost_b = cost_b[indices]
+            done_b = done_b[indices]
+        n = len(state_action_b)
+
+        with torch.no_grad():
+            # Current estimates of next state Q-values with actions = 0 and 1, in one forward pass
+            q_next_state_b = self.net(next_state_action_b.reshape(2 * n, -1)).view(n, 2)
+            # Find the minimum (minimum is best) of the two
+            q_next_state_b = q_next_state_b.min(dim=1).values
 
-        states, actions, costs, next_states, dones = zip(*experiences)
-        
-        # b means batch
-        #state_b = torch.FloatTensor(states) # This is slow
-        state_b = torch.FloatTensor(np.array(states))
-        action_b = torch.FloatTensor(actions)
-        cost_b = torch.FloatTensor(costs)
-        #next_state_b = torch.FloatTensor(next_states) # This is slow
-        next_state_b = torch.FloatTensor(np.array(next_states))
-        done_b = torch.FloatTensor(dones)
-
-        state_action_b = torch.cat([state_b, action_b.unsqueeze(1)], 1)
-        assert state_action_b.shape == (len(experiences), state_b.shape[1] + 1)
-
-        # Current estimates of next state Q-values with actions = 0
-        q_next_state_left_b = self.net(torch.cat([next_state_b, torch.zeros(len(experiences), 1)], 1)).squeeze()
-        # Current estimates of next state Q-values with actions = 1
-        q_next_state_right_b = self.net(torch.cat([next_state_b, torch.ones(len(experiences), 1)], 1)).squeeze()
-        # Find the minimum (minimum is best) of the two
-        q_next_state_b = torch.min(q_next_state_left_b, q_next_state_right_b)
-
-        with torch.no_grad(): # TODO: remove this no grad?
             target_q_values = cost_b + self.args.gamma * q_next_state_b * (1 - done_b)
 
         # Return the supervised dataset
@@ -69,11 +119,26 @@ class NFQAgent:
     def train(self, pattern_set):
         """
         Update Q-values using pattern set
+
+        Runs up to agent_epochs Rprop steps. Optionally stops earlier:
+            train_budget:     wall-clock seconds for this call (e.g. the gap between episodes on hardware)
+            plateau_patience: stop when the loss improved by less than plateau_tol (relative)
+                              over the last plateau_patience epochs
+        Losses stay on the tensor side and are only synced every loss_check_every epochs.
+        Epochs used, time spent and why training stopped are kept in self.last_train_stats.
         """
+        budget = getattr(self.args, "train_budget", None)
+        patience = getattr(self.args, "plateau_patience", 0)
+        tol = getattr(self.args, "plateau_tol", 1e-3)
+        check_every = max(1, getattr(self.args, "loss_check_every", 10))
+
         # (State, action) and respective target Q-values in a batch
         state_action_b, target_q_values = pattern_set
-        loss_collection = np.zeros(self.args.agent_epochs)
+        losses = torch.zeros(self.args.agent_epochs)
 
+        start = time.perf_counter()
+        stopped = "epochs"
+        epochs = 0
         for i in range(self.args.agent_epochs):
             predicted_q_values = self.net(state_action_b).squeeze()
             loss = nn.functional.mse_loss(predicted_q_values, target_q_values)
@@ -82,12 +147,29 @@ class NFQAgent:
             loss.backward()
             self.optimizer.step()
 
-            loss_collection[i] = loss.item()
+            losses[i] = loss.detach()
+            epochs = i + 1
+
+            if budget is not None and time.perf_counter() - start >= budget:
+                stopped = "budget"
+                break
+
+            if patience and epochs > patience and epochs % check_every == 0:
+                before, now = losses[i - patience].item(), losses[i].item()
+                if before - now <= tol * before:
+                    stopped = "plateau"
+                    break
 
-        return np.array(loss_collection), loss.item()
+        if self.numpy_net is not None:
+            self.sync_numpy_policy()
+
+        loss_collection = losses[:epochs].numpy()
+        self.last_train_stats = {"epochs": epochs, "seconds": time.perf_counter() - start, "stopped": stopped}
+
+        return loss_collection, float(loss_collection[-1])
 
     def evaluate(self, nfq_env, max_steps, epoch_no, epochs, pos_init):
-        experiences, total_cost = nfq_env.experience(self.get_best_action, max_steps, epoch_no, epochs, pos_init)
+        _, experiences, total_cost = nfq_env.experience(self.get_best_action, max_steps, epoch_no, epochs, pos_init)
         final_state = experiences[-1][3]
 
         success = (
@@ -98,5 +180,22 @@ class NFQAgent:
 
         return len(experiences), success, total_cost
 
+    def evaluate_batch(self, nfq_env, max_steps, positions):
+        """
+        Greedy evaluate for one episode per initial position, run as a batch on a BatchSteerboxNFQ
+        Returns per episode success, steps to the goal (first step reaching a goal state, -1 if none) and total cost
+        """
+        states = nfq_env.env.reset_to(positions)
+        success, (_, _, all_costs, all_next_states, _), lengths = nfq_env.rollout(self.get_best_actions, max_steps, states)
+
+        # Entries past an episode's length are unused
+        valid = np.arange(max_steps)[:, None] < lengths
+        goal, _ = nfq_env.goal_and_forbidden(all_next_states[..., 0], all_next_states[..., 1])
+        goal &= valid
+        steps_to_goal = np.where(goal.any(axis=0), goal.argmax(axis=0) + 1, -1)
+        total_cost = np.where(valid, all_costs, 0).sum(axis=0)
+
+        return success, steps_to_goal, total_cost
+
 
 
@@ -0,0 +1,177 @@
+"""
+Asynchronous actor/learner training.
+
+In NFQMain.train the controller waits for training after every episode, and on hardware training
+waits for the slow resets of the steering box. Here the two run side by side:
+    actor   (this process): runs episodes with the latest published network, sends each episode's
+            transitions to the learner and swaps in newer weights between episodes only
+    learner (a separate process): keeps the replay store, and retrains NFQ on everything it has
+            (plus hint-to-goal transitions) whenever new episodes arrived, then publishes the weights
+
+max_lag bounds how many episodes the learner may fall behind, the actor waits for newer weights
+beyond that (0: never wait, as on hardware). On the fast simulation the actor would otherwise
+run far ahead of the learner.
+
+Evaluation, profiling, the replay directory, policy export and the run history are not wired into
+this mode, NFQ_main rejects those flags together with --async_learner (unsupported_flags).
+
+Use case:
+    python NFQ_main.py --async_learner --max_lag 2
+"""
+import os
+import time
+import queue
+import random
+import multiprocessing
+import numpy as np
+import torch
+
+from NFQ_Agent import NFQAgent
+from Replay_Store import ReplayStore
+from Vehicle_Env import Simulation
+from Steerbox_Env import SteerboxEnv
+from Steerbox_NFQ import SteerboxNFQ, HintToGoal, PatternSetSampler
+from Utils.metrics import EpisodeMetrics
+from Utils.plot_sinks import make_plot_sink
+from Utils.episode_log import BackgroundEpisodeLogWriter, experiences_to_arrays, state_dict_to_numpy
+from Utils.exploration_strategies import exploration_strategies
+
+# NFQ_main flags that only the synchronous training loop implements
+unsupported_flags = ("eval_every", "profile", "chrome_trace", "replay_dir", "export_policy", "pattern_every", "spill_dir", "history_budget_mb")
+
+def learner(args, seed, transitions, weights):
+    """
+    Learner process: train on the growing replay, publish (episode, weights, last loss) after every training
+    """
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    agent = NFQAgent(args)
+    replay = ReplayStore()
+    nfq_env = SteerboxNFQ(None)
+    hints = HintToGoal(nfq_env, args.hint_size)
+    sampler = PatternSetSampler(nfq_env, args.pattern_cap, args.recency_half_life)
+    learned_upto = 0
+
+    while True:
+        # Block for new data, then take everything that is queued
+        batches = [transitions.get()]
+        while True:
+            try:
+                batches.append(transitions.get_nowait())
+            except queue.Empty:
+                break
+
+        for batch in batches:
+            if batch is None:
+                return
+            episode, arrays = batch
+            replay.extend_arrays(arrays["states"], arrays["actions"], arrays["costs"], arrays["next_states"], arrays["dones"], episode)
+
+        upto = batches[-1][0]
+        state_action_b, target_q_values = agent.generate_pattern_set(replay, sampler.sample(replay))
+        t_goal_state_action_b, t_goal_target_q_values = hints.top_up(len(state_action_b))
+        state_action_b = torch.cat([state_action_b, t_goal_state_action_b], dim=0)
+        target_q_values = torch.cat([target_q_values, t_goal_target_q_values], dim=0)
+
+        # Reset as the serial loop would have, if an episode in (learned_upto, upto] is a reset episode
+        if upto // args.reset_freq > learned_upto // args.reset_freq:
+            agent = NFQAgent(args)
+
+        _, last_step_loss = agent.train((state_action_b, target_q_values))
+        learned_upto = upto
+        weights.put((upto, state_dict_to_numpy(agent.net.state_dict()), last_step_loss))
+
+def run_async_experiment(args, seed, index=0):
+    """
+    NFQMain.run_experiment with the learner in another process, returns the same per episode results
+    """
+    print(f"Experiment: {index}, seed ={seed} (asynchronous learner)")
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    env = Simulation()
+    env.build(args.data_dir, use_cache=not args.no_sim_cache)
+    plot_sink = make_plot_sink(args.plots)
+    nfq_env = SteerboxNFQ(SteerboxEnv(env, env_type='simulation'), plot_sink)
+    agent = NFQAgent(args)
+    if args.save_to_file:
+        os.makedirs(f"./{args.env}_Data", exist_ok=True)
+        episode_log = BackgroundEpisodeLogWriter(f"./{args.env}_Data/episode_" + time.strftime("%Y%m%d_%H%M%S") + f"_exp{index}.nfqlog")
+
+    context = multiprocessing.get_context("spawn")
+    transitions = context.Queue()
+    weights = context.Queue()
+    process = context.Process(target=learner, args=(args, random.randint(0, 1000000), transitions, weights), name="nfq-learner")
+    process.start()
+
+    metrics = EpisodeMetrics(args.episodes)
+    weights_episode = np.zeros(args.episodes) # episode the network that ran each episode was trained up to
+    published = 0
+    last_loss = np.nan
+    swaps = 0
+
+    def swap(block):
+        # Take the newest published weights, only ever between episodes
+        nonlocal published, last_loss, swaps
+        latest = None
+        try:
+            latest = weights.get(timeout=1) if block else weights.get_nowait()
+            while True:
+                latest = weights.get_nowait()
+        except queue.Empty:
+            pass
+        if latest is not None:
+            published, state, last_loss = latest
+            agent.load_state(state)
+            swaps += 1
+
+    start = time.time()
+    print(f"\n\nStarted Training for {args.episodes} episodes")
+    print("................................")
+    try:
+        for ep in range(1, args.episodes+1):
+            swap(block=False)
+            while args.max_lag and ep - 1 - published > args.max_lag:
+                if not process.is_alive():
+                    raise RuntimeError("Learner process stopped")
+                swap(block=True)
+
+            exploration = exploration_strategies(agent, args.exploration, ep, args.episodes)
+            success, new_experiences, episode_cost = nfq_env.experience(exploration, args.train_max_steps, ep, args.episodes, args.pos_init)
+            transitions.put((ep, experiences_to_arrays(new_experiences)))
+
+            metrics.update(episode_cost, success, len(new_experiences), last_loss)
+            weights_episode[ep-1] = published
+            if args.save_to_file:
+                episode_log.append_episode(ep, new_experiences, (len(new_experiences), episode_cost, last_loss), agent.net.state_dict())
+    finally:
+        transitions.put(None)
+        process.join()
+        if args.save_to_file:
+            episode_log.close()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Learner process failed (exit code {process.exitcode})")
+
+    end = time.time()
+    print("................................ END ................................")
+    print(f"\n\tTotal Time elapsed during training= {round((end - start), 2)} seconds")
+    print(f"\tWeights swapped {swaps} times, mean lag of the acting network: {np.mean(np.arange(args.episodes) - weights_episode):.2f} episodes")
+    print("\n.....................................................................\n")
+
+    if args.num_experiments == 1:
+        plot_sink.emit("cost", metrics.cost, args.episodes, metrics.cost_moving_average())
+    plot_sink.close()
+
+    return {
+        "seed": seed,
+        "time": end - start,
+        "cost": metrics.cost,
+        "success": metrics.success,
+        "length": metrics.length,
+        "loss": metrics.loss,
+        "lag": np.arange(args.episodes) - weights_episode,
+    }
@@ -0,0 +1,293 @@
+"""
+Train many NFQ networks at once.
+
+The NFQ networks (39 to 171 parameters) are far too small to keep a core busy, so comparing
+network sizes or seeds as separate processes mostly pays for overhead. NFQEnsemble stacks K
+independent networks into batched, zero-padded weight tensors: hidden layers are padded to the
+widest member and masked, so every member computes exactly its own NFQNetwork.
+Rprop is element-wise (each weight only sees the sign of its own gradient), so a single
+optimizer over the stacked tensors keeps independent Rprop state for every member.
+
+Use case:
+    # all five network sizes, 3 seeds each, one simulated episode per member per training episode
+    python NFQ_Ensemble.py --member_params 39 61 91 121 171 --members_per_size 3
+"""
+import os
+import time
+import random
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from NFQ_model import NFQNetwork
+from Replay_Store import ReplayStore
+from Vehicle_Env import Simulation
+from Steerbox_Env import BatchSteerboxEnv
+from Steerbox_NFQ import BatchSteerboxNFQ, HintToGoal
+from Utils.exploration_strategies import batch_explore
+from Utils.results import aggregate_runs, save_table
+
+class NFQEnsemble:
+    def __init__(self, param_counts, seeds=None):
+        self.param_counts = list(param_counts)
+        self.k = len(self.param_counts)
+        members = [self.new_member(i, None if seeds is None else seeds[i]) for i in range(self.k)]
+
+        # Padded shapes: widest member per layer
+        layer_shapes = [[tuple(layer.weight.shape) for layer in member] for member in members]
+        self.n_layers = len(layer_shapes[0])
+        self.shapes = [(max(s[l][0] for s in layer_shapes), max(s[l][1] for s in layer_shapes)) for l in range(self.n_layers)]
+
+        self.weights = []
+        self.biases = []
+        self.masks = []
+        for out_max, in_max in self.shapes:
+            self.weights.append(nn.Parameter(torch.zeros(self.k, out_max, in_max)))
+            self.biases.append(nn.Parameter(torch.zeros(self.k, out_max)))
+            self.masks.append(torch.zeros(self.k, out_max, in_max))
+
+        with torch.no_grad():
+            for i, member in enumerate(members):
+                self.load_member(i, member)
+
+        self.optimizer = optim.Rprop(self.parameters()) # Rprop is the default for NFQ
+        self.lr = self.optimizer.defaults["lr"]
+
+    def new_member(self, i, seed=None):
+        if seed is not None:
+            torch.manual_seed(seed)
+        net = NFQNetwork(self.param_counts[i])
+        return [m for m in net.layers if isinstance(m, nn.Linear)]
+
+    def parameters(self):
+        return self.weights + self.biases
+
+    def load_member(self, i, linears):
+        for l, layer in enumerate(linears):
+            out_dim, in_dim = layer.weight.shape
+            self.weights[l][i].zero_()
+            self.biases[l][i].zero_()
+            self.masks[l][i].zero_()
+            self.weights[l][i, :out_dim, :in_dim] = layer.weight.detach()
+            self.biases[l][i, :out_dim] = layer.bias.detach()
+            self.masks[l][i, :out_dim, :in_dim] = 1
+
+    def reset_member(self, i, seed=None):
+        """
+        New weights and fresh Rprop state for one member (NFQMain creates a new NFQAgent on reset)
+        """
+        with torch.no_grad():
+            self.load_member(i, self.new_member(i, seed))
+            for p in self.parameters():
+                state = self.optimizer.state.get(p)
+                if state:
+                    state["prev"][i].zero_()
+                    state["step_size"][i].fill_(self.lr)
+
+    def reset_all(self):
+        for i in range(self.k):
+            self.reset_member(i)
+
+    def forward(self, x, members=None):
+        """
+        x: (K, B, 4), one batch per member. With members (N,), x is (N, B, 4) and row n
+        is evaluated by member members[n].
+        """
+        for weight, bias, mask in zip(self.weights, self.biases, self.masks):
+            w = weight * mask
+            b = bias
+            if members is not None:
+                w, b = w[members], b[members]
+            x = torch.sigmoid(torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2)))
+        return x
+
+    def member_state_dict(self, i):
+        """
+        NFQNetwork state_dict of one member (e.g. to hand over to NFQAgent or to export)
+        """
+        state = {}
+        for l, linear_index in enumerate(range(0, 2 * self.n_layers, 2)):
+            out_dim = int(self.masks[l][i, :, 0].sum())
+            in_dim = int(self.masks[l][i, 0, :].sum())
+            state[f"layers.{linear_index}.weight"] = self.weights[l][i, :out_dim, :in_dim].detach().clone()
+            state[f"layers.{linear_index}.bias"] = self.biases[l][i, :out_dim].detach().clone()
+        return state
+
+    def get_best_actions(self, states, members=None):
+        """
+        states (N, 3). Without members every member acts on every state, returns (K, N).
+        With members (N,), state n is acted on by member members[n], returns (N,).
+        """
+        states = torch.as_tensor(np.asarray(states), dtype=torch.float32)
+        n = len(states)
+        x = torch.zeros(n, 2, 4)
+        x[:, :, :3] = states.unsqueeze(1)
+        x[:, 1, 3] = 1
+
+        with torch.inference_mode():
+            if members is None:
+                q = self.forward(x.reshape(1, 2 * n, 4).expand(self.k, -1, -1)).view(self.k, n, 2)
+            else:
+                q = self.forward(x, torch.as_tensor(members)).view(n, 2)
+
+        # Lower Q value is better, same tie-breaking as NFQAgent.get_best_action
+        return (q[..., 0] >= q[..., 1]).long().numpy()
+
+    @staticmethod
+    def pad(tensors, fill=0.0):
+        """
+        List of K tensors (n_k, ...) -> (K, max n_k, ...) and a (K, max n_k) mask
+        """
+        n_max = max(len(t) for t in tensors)
+        out = torch.full((len(tensors), n_max) + tuple(tensors[0].shape[1:]), fill)
+        mask = torch.zeros(len(tensors), n_max)
+        for i, t in enumerate(tensors):
+            out[i, :len(t)] = t
+            mask[i, :len(t)] = 1
+        return out, mask
+
+    def generate_pattern_sets(self, stores, gamma):
+        """
+        NFQAgent.generate_pattern_set for every member on its own ReplayStore
+        """
+        next_inputs, mask = self.pad([store.next_state_action.reshape(-1, 4) for store in stores])
+        with torch.no_grad():
+            q_next = self.forward(next_inputs).view(self.k, -1, 2).min(dim=2).values
+
+        pattern_sets = []
+        for i, store in enumerate(stores):
+            n = len(store)
+            target_q_values = store.cost + gamma * q_next[i, :n] * (1 - store.done)
+            pattern_sets.append((store.state_action, target_q_values))
+        return pattern_sets
+
+    def train(self, pattern_sets, epochs):
+        """
+        pattern_sets: one (state_action_b, target_q_values) per member, or a single shared one.
+        Each member minimises its own mean squared error. Returns losses as (epochs, K).
+        """
+        if isinstance(pattern_sets, tuple):
+            x, y = pattern_sets
+            x = x.unsqueeze(0).expand(self.k, -1, -1)
+            y = y.unsqueeze(0).expand(self.k, -1)
+            mask = torch.ones(self.k, x.shape[1])
+        else:
+            x, mask = self.pad([p[0] for p in pattern_sets])
+            y, _ = self.pad([p[1] for p in pattern_sets])
+        counts = mask.sum(dim=1)
+
+        losses = torch.zeros(epochs, self.k)
+        for e in range(epochs):
+            predicted_q_values = self.forward(x).squeeze(2)
+            member_loss = (((predicted_q_values - y) ** 2) * mask).sum(dim=1) / counts
+
+            self.optimizer.zero_grad()
+            # Sum of independent losses: each member only gets the gradient of its own
+            member_loss.sum().backward()
+            self.optimizer.step()
+
+            losses[e] = member_loss.detach()
+        return losses.numpy()
+
+def run_ensemble(args, param_counts, seed):
+    """
+    NFQMain.train for K agents at once: every training episode, each member runs its own simulated
+    episode (batched through BatchSteerboxNFQ) and then all members train together.
+    Returns one result dict per member (same keys as NFQMain.run_experiment).
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    member_seeds = [random.randint(0, 1000000) for _ in param_counts]
+
+    sim = Simulation()
+    sim.build(args.data_dir, use_cache=not args.no_sim_cache)
+    nfq_env = BatchSteerboxNFQ(BatchSteerboxEnv(sim))
+
+    ensemble = NFQEnsemble(param_counts, member_seeds)
+    k = ensemble.k
+    stores = [ReplayStore() for _ in range(k)]
+    hints = [HintToGoal(nfq_env, args.hint_size) for _ in range(k)]
+
+    results = [{
+        "seed": member_seeds[i],
+        "num_params": param_counts[i],
+        "cost": np.zeros(args.episodes),
+        "success": np.zeros(args.episodes),
+        "length": np.zeros(args.episodes),
+        "loss": np.zeros(args.episodes),
+    } for i in range(k)]
+
+    start = time.time()
+    print(f"\n\nStarted Training {k} networks for {args.episodes} episodes")
+    print("................................")
+    for ep in range(1, args.episodes+1):
+
+        def policy(states, members):
+            # member i acts in episode i, with its own exploration draws
+            return batch_explore(ensemble.get_best_actions(states, members), args.exploration, ep, args.episodes)
+
+        states = nfq_env.reset(k, ep, args.episodes, args.pos_init)
+        success, arrays, lengths = nfq_env.rollout(policy, args.train_max_steps, states, pass_index=True)
+        all_states, all_actions, all_costs, all_next_states, all_failed = arrays
+
+        for i in range(k):
+            n = lengths[i]
+            stores[i].extend_arrays(all_states[:n, i], all_actions[:n, i], all_costs[:n, i], all_next_states[:n, i], all_failed[:n, i])
+            results[i]["cost"][ep-1] = sum(all_costs[:n, i].tolist(), 0.0)
+            results[i]["success"][ep-1] = success[i]
+            results[i]["length"][ep-1] = n
+
+        pattern_sets = ensemble.generate_pattern_sets(stores, args.gamma)
+
+        # hint-to-goal transitions, as in NFQMain.train
+        for i in range(k):
+            goal_state_action_b, goal_target_q_values = hints[i].top_up(len(stores[i]))
+            state_action_b, target_q_values = pattern_sets[i]
+            pattern_sets[i] = (
+                torch.cat([state_action_b, goal_state_action_b], dim=0),
+                torch.cat([target_q_values, goal_target_q_values], dim=0),
+            )
+
+        # Reset the Neural Networks (Q-function approximators)
+        if ep % args.reset_freq == 0:
+            print("\nResetting Networks and Optimizer state\n")
+            ensemble.reset_all()
+
+        losses = ensemble.train(pattern_sets, args.agent_epochs)
+        for i in range(k):
+            results[i]["loss"][ep-1] = losses[-1, i]
+
+        print(f"Episode: {ep}, successes: {int(success.sum())}/{k}, mean cost: {np.mean([r['cost'][ep-1] for r in results]):.3f}")
+
+    end = time.time()
+    print("................................ END ................................")
+    print(f"\n\tTotal Time elapsed during training= {round((end - start), 2)} seconds")
+    for r in results:
+        r["time"] = end - start
+    return ensemble, results
+
+if __name__ == "__main__":
+    from NFQ_main import get_parser
+
+    parser = get_parser()
+    parser.add_argument("--member_params", type=int, nargs="+", default=[39, 61, 91, 121, 171], help="Parameter count of each network size in the ensemble")
+    parser.add_argument("--members_per_size", type=int, default=1, help="Independently seeded networks per size")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed (default: random)")
+    args = parser.parse_args()
+
+    param_counts = [p for p in args.member_params for _ in range(args.members_per_size)]
+    seed = args.seed if args.seed is not None else random.randint(0, 1000000)
+    ensemble, results = run_ensemble(args, param_counts, seed)
+
+    print(f"Stats:")
+    for size in args.member_params:
+        runs = [r for r in results if r["num_params"] == size]
+        print(f"\t{size} params: episodes with success {[int(r['success'].sum()) for r in runs]}, mean cost of last 10 episodes {np.mean([r['cost'][-10:].mean() for r in runs]):.4f}")
+        if args.save_to_file:
+            save_folder = f"./{args.env}_Data"
+            os.makedirs(save_folder, exist_ok=True)
+            table_path = save_folder + f"/ensemble_{size}_"+time.strftime("%Y%m%d_%H%M%S")+".csv"
+            save_table(aggregate_runs(runs), table_path)
+            print(f"\t\tAveraged results: {table_path}")
@@ -0,0 +1,122 @@
+"""
+Greedy evaluation of network snapshots, off the training loop.
+
+The training episodes mix exploration into the cost curve. Every eval_every episodes the trained
+network is handed to an evaluation process instead, which runs it greedily from a fixed, seeded
+set of initial wheel positions, all episodes as one batch (NFQAgent.evaluate_batch), and reports
+per snapshot:
+    success_rate   episodes that survived every step and ended in the goal region
+    steps_to_goal  mean step of the first goal state, over the episodes that reached it
+    cost           mean total cost of an episode
+Training only queues the weights and collects the reports between episodes, it never waits on them.
+
+Use case:
+    python NFQ_main.py --eval_every 10 --eval_episodes 100 --save_to_file
+"""
+import queue
+import multiprocessing
+import numpy as np
+import torch
+
+from NFQ_Agent import NFQAgent
+from Vehicle_Env import Simulation, CompiledSimulation
+from Steerbox_Env import CompiledBatchSteerboxEnv
+from Steerbox_NFQ import BatchSteerboxNFQ
+from Utils.episode_log import state_dict_to_numpy
+
+def evaluation_positions(n, seed=0):
+    """
+    The fixed initial wheel positions, same range as the uniform initialization
+    """
+    return np.random.default_rng(seed).uniform(-0.5, 0.5, n)
+
+def evaluate_snapshot(agent, nfq_env, positions, max_steps):
+    success, steps_to_goal, cost = agent.evaluate_batch(nfq_env, max_steps, positions)
+    reached = steps_to_goal >= 0
+    return {
+        "success_rate": float(success.mean()),
+        "steps_to_goal": float(steps_to_goal[reached].mean()) if reached.any() else np.nan,
+        "cost": float(cost.mean()),
+    }
+
+def evaluator(args, snapshots, reports):
+    """
+    Evaluation process: evaluate every (episode, weights) snapshot, report (episode, results)
+    """
+    torch.set_num_threads(1)
+    env = Simulation()
+    env.build(args.data_dir, use_cache=not args.no_sim_cache)
+    # Lookups fill in lazily and are shared by all snapshots, states are the same as with the trees
+    nfq_env = BatchSteerboxNFQ(CompiledBatchSteerboxEnv(CompiledSimulation(env, use_cache=not args.no_sim_cache)))
+    positions = evaluation_positions(args.eval_episodes, args.eval_seed)
+    agent = NFQAgent(args)
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            return
+        episode, state = snapshot
+        agent.load_state(state)
+        reports.put((episode, evaluate_snapshot(agent, nfq_env, positions, args.test_max_steps)))
+
+class EvaluationService:
+    def __init__(self, args):
+        context = multiprocessing.get_context("spawn")
+        self.snapshots = context.Queue()
+        self.reports = context.Queue()
+        self.process = context.Process(target=evaluator, args=(args, self.snapshots, self.reports), name="nfq-evaluator")
+        self.process.start()
+        self.results = [] # (episode, results) in the order they arrived
+        self.submitted = 0
+
+    def submit(self, episode, state_dict):
+        self.snapshots.put((episode, state_dict_to_numpy(state_dict)))
+        self.submitted += 1
+
+    def collect(self, episode, results):
+        self.results.append((episode, results))
+        print("\tEvaluation of episode {}: success rate {success_rate:.2f}, steps to goal {steps_to_goal:.1f}, cost {cost:.4f}".format(episode, **results))
+
+    def poll(self):
+        """
+        Collect and print the reports that are ready
+        """
+        while True:
+            try:
+                self.collect(*self.reports.get_nowait())
+            except queue.Empty:
+                return
+
+    def close(self):
+        """
+        Wait for a report of every submitted snapshot, unless the evaluation process failed
+        """
+        self.snapshots.put(None)
+        while len(self.results) < self.submitted:
+            try:
+                self.collect(*self.reports.get(timeout=1))
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                if self.process.exitcode != 0:
+                    break
+                # It exited normally, whatever it reported is in the queue already
+                try:
+                    self.collect(*self.reports.get(timeout=1))
+                except queue.Empty:
+                    break
+        self.process.join()
+        if self.process.exitcode != 0:
+            raise RuntimeError(f"Evaluation process failed (exit code {self.process.exitcode})")
+        if len(self.results) < self.submitted:
+            raise RuntimeError(f"Evaluation process reported {len(self.results)} of {self.submitted} snapshots")
+
+    def table(self):
+        """
+        Columns episode, success_rate, steps_to_goal, cost (one row per snapshot), as for Utils.results.save_table
+        """
+        results = sorted(self.results, key=lambda r: r[0])
+        table = {"episode": np.array([episode for episode, _ in results])}
+        for name in ("success_rate", "steps_to_goal", "cost"):
+            table[name] = np.array([r[name] for _, r in results])
+        return table
@@ -13,20 +13,29 @@ NFQ paper: https://ml.informatik.uni-freiburg.de/former/_media/publications/riee
 import os
 import sys
 import time 
-import lzma 
 import random
 import argparse
 
-import pickle
+import multiprocessing
 import numpy as np 
 import torch 
+from concurrent.futures import ProcessPoolExecutor
 
 from NFQ_Agent import NFQAgent
 from NFQ_model import NFQNetwork
 from Vehicle_Env import Simulation
+from Replay_Store import ReplayStore, MappedReplayStore
 from Steerbox_Env import SteerboxEnv
-from Steerbox_NFQ import SteerboxNFQ 
-from Utils.plots import Plots
+from Steerbox_NFQ import SteerboxNFQ, HintToGoal, PatternSetSampler
+from NFQ_Async import run_async_experiment, unsupported_flags
+from NFQ_Eval import EvaluationService
+from Utils.plot_sinks import make_plot_sink
+from Utils.results import aggregate_runs, save_table
+from Utils.metrics import EpisodeMetrics
+from Utils.episode_log import BackgroundEpisodeLogWriter
+from Utils.run_history import RunHistory
+from Utils.profiler import Profiler
+from Utils.export_policy import export_policy
 
 from Utils.exploration_strategies import exploration_strategies
 
@@ -35,7 +44,6 @@ class NFQMain:
         self.args = args 
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print("Using device: ", self.device)
-        self.plots = Plots()
         
     def train(self):
         
@@ -45,12 +53,67 @@ class NFQMain:
         print(f"\nRunning the following experiment:\n\t1. Neural Network Parameter count: {self.args.num_params}\
             \n\t2. Size of Hint-to-goal transitions: {self.args.hint_size}%\n\t3. Exploration strategy: {self.args.exploration}\
             \n\t4. Neural network reset frequency: every {self.args.reset_freq} episodes\n\t5. Steering wheel position initialization: {self.args.pos_init}\n")
-        
-        # TODO: make it work on multiple (5) experiments at a time and average the results
-        #for i in range(self.args.num_experiments):
-        #print(f"Experiment: {i}, seed ={seeds[i]}")
 
-        seed = seeds[0]
+        if len(seeds) == 1:
+            results = [self.run_experiment(seeds[0])]
+        else:
+            results = self.run_parallel(seeds)
+
+        if len(results) > 1:
+            # Average the experiments, per episode mean and confidence band
+            table = aggregate_runs(results)
+            plot_sink = make_plot_sink(self.args.plots)
+            plot_sink.emit("cost_bands", table, self.args.episodes)
+            plot_sink.close()
+            if self.args.save_to_file:
+                table_path = self.save_folder() + "/results_"+time.strftime("%Y%m%d_%H%M%S")+".csv"
+                save_table(table, table_path)
+                print(f"Averaged results: {table_path}")
+
+        print("Find all polots in the Plots folder.")
+        if self.args.save_to_file:
+            print("Also find the data of current run.")
+
+        print(f"Stats:")
+        for i, result in enumerate(results):
+            print(f"\tExperiment: {i}, seed ={result['seed']}, Episodes with success: {int(result['success'].sum())}, time: {round(result['time'], 2)} seconds")
+
+    def run_parallel(self, seeds):
+        """
+        Run one experiment per seed across a process pool, each worker with its own RNG state
+        """
+        # Build the simulation once here, workers then load (memory-map) the cached arrays instead of decoding the data
+        if self.args.env == "Simulation" and not self.args.no_sim_cache:
+            Simulation().build(self.args.data_dir)
+
+        workers = min(len(seeds), self.args.workers or os.cpu_count() or 1)
+        print(f"Running {len(seeds)} experiments on {workers} processes")
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(run_experiment, self.args, seed, i) for i, seed in enumerate(seeds)]
+            return [future.result() for future in futures]
+
+    def save_folder(self):
+        save_folder = f"./{self.args.env}_Data"
+        if not os.path.exists(save_folder):
+            os.makedirs(save_folder, exist_ok=True)
+        return save_folder
+
+    def make_profiler(self, index):
+        if not self.args.profile:
+            return Profiler()
+        name = self.args.profile_dir + "/profile_" + time.strftime("%Y%m%d_%H%M%S") + f"_exp{index}"
+        return Profiler(name + ".jsonl", name + ".trace.json" if self.args.chrome_trace else None)
+
+    def run_experiment(self, seed, index=0):
+        """
+        One full training run, returns per episode cost, success, length and loss
+        """
+        if self.args.async_learner:
+            return run_async_experiment(self.args, seed, index)
+
+        print(f"Experiment: {index}, seed ={seed}")
         random.seed(seed)
         np.random.seed(seed)
         torch.manual_seed(seed)
@@ -59,170 +122,237 @@ class NFQMain:
         if self.args.env == "Simulation":
             self.env = Simulation()
             self.steer_env = SteerboxEnv(self.env, env_type='simulation')
-            self.env.build(self.args.data_dir)
+            self.env.build(self.args.data_dir, use_cache=not self.args.no_sim_cache)
 
             # Create folder to save sim data if required
             if self.args.save_to_file:
-                save_folder = f"./{self.args.env}_Data"
-                if not os.path.exists(save_folder):
-                    os.mkdir(save_folder)
-            data_file_path = save_folder + "/episode_"+time.strftime("%Y%m%d_%H%M%S")+".pickle.xz"
+                data_file_path = self.save_folder() + "/episode_"+time.strftime("%Y%m%d_%H%M%S")+f"_exp{index}.nfqlog"
+                episode_log = BackgroundEpisodeLogWriter(data_file_path)
 
         else:
             # TODO: implement hardware environment
             print("Hardware environment not implemented in the main code base yet.")
             sys.exit()
         
-        self.nfq_env = SteerboxNFQ(self.steer_env)
+        # Figures are rendered by the plot sink, not in the training loop (unless --plots sync)
+        plot_sink = make_plot_sink(self.args.plots)
+        self.nfq_env = SteerboxNFQ(self.steer_env, plot_sink)
         self.nfq_agent = NFQAgent(self.args)   
 
+        # Per-phase timing, a no-op unless --profile
+        profiler = self.make_profiler(index)
+        if profiler.enabled:
+            self.env.query = profiler.wrap("env_query", self.env.query)
+
         # Things that measure, collect
         start = time.time()
-        total_cost = 0
-        success_count = 0 
 
-        all_learn_data = [] 
-        all_experiences = [] 
-        loss_total = [] 
+        # Per episode results (cost, success, length, loss) with running statistics, merged across experiments
+        metrics = EpisodeMetrics(self.args.episodes)
+        episode_train_epochs = np.zeros(self.args.episodes)
+        episode_train_time = np.zeros(self.args.episodes)
+        episode_pattern_size = np.zeros(self.args.episodes) # transitions trained on, without the hints
+
+        # Summary of every episode, pattern sets only as the retention policy allows
+        history = RunHistory(
+            pattern_every=self.args.pattern_every,
+            spill_dir=self.args.spill_dir,
+            max_bytes=None if self.args.history_budget_mb is None else int(self.args.history_budget_mb * 2**20),
+        )
+        # every transition so far, as tensors for the pattern set (on a memory-mapped file with a replay_dir)
+        if self.args.replay_dir is None:
+            replay = ReplayStore()
+        else:
+            replay = MappedReplayStore(self.args.replay_dir + "/replay_" + time.strftime("%Y%m%d_%H%M%S") + f"_exp{index}")
+            print(f"Replay store: {replay.path}")
+
+        # Greedy evaluation of every eval_every-th network, in its own process
+        evaluation = EvaluationService(self.args) if self.args.eval_every else None
 
-        # Store hint-to-goal transitions (state, action) and q_value
-        goal_state_action_b = []
-        goal_target_q_values = []
+        # Hint-to-goal transitions (state, action) and q_value, kept at hint_size % of the transitions
+        hints = HintToGoal(self.nfq_env, self.args.hint_size)
+        # Without a pattern_cap every transition is trained on
+        sampler = PatternSetSampler(self.nfq_env, self.args.pattern_cap, self.args.recency_half_life)
 
         print(f"\n\nStarted Training for {self.args.episodes} episodes")
         print("................................")
-        for ep in range(1, self.args.episodes+1):
-            print(f"Episode: {ep}")
-
-            # Which strategy to use for exploration
-            exploration = exploration_strategies(self.nfq_agent, self.args.exploration, ep)
-
-
-            # Perform an agent rollout
-            success, new_experiences, episode_cost = self.nfq_env.experience(
-                lambda *args: exploration(*args),
-                self.args.train_max_steps,
-                ep,
-                self.args.episodes,
-                self.args.pos_init
-            )
-            success_count += success
-            all_experiences.extend(new_experiences)
-            total_cost += episode_cost
-
-            # Generate the pattern set
-            state_action_b, target_q_values = self.nfq_agent.generate_pattern_set(all_experiences)
-
-            # hint-to-goal (% of total transitions), has to be calculated every time
-            # only calculate how much to add i.e. the difference between desired and current
-            new_size = int((1/100)*self.args.hint_size + 1) - len(goal_state_action_b)
+        try:
+            for ep in range(1, self.args.episodes+1):
+                print(f"Episode: {ep}")
+
+                # Which strategy to use for exploration
+                exploration = exploration_strategies(self.nfq_agent, self.args.exploration, ep, self.args.episodes)
+
+
+                # Perform an agent rollout
+                with profiler.span("rollout"):
+                    success, new_experiences, episode_cost = self.nfq_env.experience(
+                        profiler.wrap("action_selection", exploration),
+                        self.args.train_max_steps,
+                        ep,
+                        self.args.episodes,
+                        self.args.pos_init
+                    )
+                replay.extend(new_experiences, ep)
+
+                # Generate the pattern set
+                with profiler.span("pattern_set"):
+                    state_action_b, target_q_values = self.nfq_agent.generate_pattern_set(replay, sampler.sample(replay))
+                    episode_pattern_size[ep-1] = len(state_action_b)
+
+                with profiler.span("hint_to_goal"):
+                    # hint-to-goal (% of total transitions), only the difference between desired and current is sampled
+                    t_goal_state_action_b, t_goal_target_q_values = hints.top_up(len(state_action_b))
+
+                    # Attach hint-to-goal transitions
+                    state_action_b = torch.cat([state_action_b, t_goal_state_action_b], dim=0)
+                    target_q_values = torch.cat([target_q_values, t_goal_target_q_values], dim=0)
+
+                # Hand over the current neural network
+                old_agent = self.nfq_agent
+
+                # Reset the Neural Network (Q-function approximator)
+                if ep % self.args.reset_freq == 0:
+                    # Reset the weights
+                    print("\nResetting Network and Optimizer\n")
+                    self.nfq_agent = NFQAgent(self.args)
             
-            # Goal pattern set 
-            new_goal_state_action_b, new_goal_target_q_values = self.nfq_env.generate_goal_pattern_set(size = new_size)
-            goal_state_action_b.extend(new_goal_state_action_b)
-            goal_target_q_values.extend(new_goal_target_q_values)
-
-            # Convert to tensors
-            t_goal_state_action_b = torch.FloatTensor(np.array(goal_state_action_b)) 
-            t_goal_target_q_values = torch.FloatTensor(np.array(goal_target_q_values)) 
-
-            # Attach hint-to-goal transitions
-            state_action_b = torch.cat([state_action_b, t_goal_state_action_b], dim=0)
-            target_q_values = torch.cat([target_q_values, t_goal_target_q_values], dim=0)
-
-            # Hand over the current neural network
-            old_agent = self.nfq_agent
-
-            # Reset the Neural Network (Q-function approximator)
-            if ep % self.args.reset_freq == 0:
-                # Reset the weights
-                print("\nResetting Network and Optimizer\n")
-                self.nfq_agent = NFQAgent(self.args)
-            
-            # Train the agent
-            loss_collection, last_step_loss = self.nfq_agent.train((state_action_b, target_q_values))
-            loss_total.append(loss_collection)
-
-            # DIABLE STAND-ALONE EVALUATION 
-            # # Some metrics for evaluations 
-            # num_evals = 0
-            # eval_episode_length = 0
-            # eval_episode_cost = 0
-
-            # # Evaluate the agent 
-            # while False: 
-            #     eval_episode_length, eval_success, eval_episode_cost = nfq_agent.evaluate(nfq_env, EVAL_ENV_MAX_STEPS, epoch, EPOCHS, self.args.pos_init)
-            #     if not eval_success: 
-            #         break
-            #     num_evals += 1
-
-
-            # remember everything about this epoch
-            all_learn_data.append({
-                "epoch": ep, # index
-                
-                # length of episode, its total cost, and the loss of the last step
-                "episode": (len(new_experiences), episode_cost, last_step_loss),
-
-                # list of (state, action, cost, next_state, failed) tuples
-                "all_experiences": all_experiences,
-                
-                # list of (*state, action) tuples given as input to the network
-                "state_action_b": np.asarray(state_action_b),
-                
-                # the Q function values the network should learn
-                "target_q_values": np.asarray(target_q_values),
-                
-                # the network that generated the above values and ran this episode
-                "net_state": old_agent.net.state_dict(),
-            })
-            
-            # At the end of the epsodes, save data
-            # Saving will take time 
+                # Train the agent
+                with profiler.span("train"):
+                    _, last_step_loss = self.nfq_agent.train((state_action_b, target_q_values))
+
+                metrics.update(episode_cost, success, len(new_experiences), last_step_loss)
+                episode_train_epochs[ep-1] = self.nfq_agent.last_train_stats["epochs"]
+                episode_train_time[ep-1] = self.nfq_agent.last_train_stats["seconds"]
+                if self.args.pattern_cap is not None:
+                    print(f"\tPattern set: {len(state_action_b) - len(t_goal_state_action_b)} of {len(replay)} transitions ("
+                          + ", ".join(f"{k}: {v}" for k, v in sampler.counts.items()) + f"), {len(t_goal_state_action_b)} hints")
+                if self.args.train_budget is not None or self.args.plateau_patience:
+                    print("\tTrained {epochs} epochs in {seconds:.3f} s, stopped on {stopped}".format(**self.nfq_agent.last_train_stats))
+
+                # Stand-alone evaluation of the trained network, reports are printed as they come in
+                if evaluation is not None:
+                    if ep % self.args.eval_every == 0:
+                        evaluation.submit(ep, self.nfq_agent.net.state_dict())
+                    evaluation.poll()
+
+
+                # remember this epoch: the (*state, action) inputs and target Q values it trained on,
+                # and the network that generated them and ran this episode
+                with profiler.span("history"):
+                    history.append(ep, (len(new_experiences), episode_cost, last_step_loss), state_action_b, target_q_values, old_agent.net.state_dict())
+                if ep % 50 == 0:
+                    print(f"\tRun history: {history.nbytes() / 2**20:.2f} MB, replay: {len(replay)} transitions")
+                    summary = metrics.summary()
+                    print("\tCost moving average: {cost_avg:.4f}, success rate: {success_rate:.2f} (last 30 episodes: {recent_success_rate:.2f})".format(**summary))
+                    print("\tLoss percentiles (5/50/95): " + "/".join(f"{v:.2e}" for v in summary["loss_percentiles"]))
+
+                # Append this episode's delta (new transitions, stats and network) to the run log
+                # Written by a background thread, this only copies the delta
+                if self.args.save_to_file:
+                    with profiler.span("checkpoint"):
+                        episode_log.append_episode(ep, new_experiences, history[-1]["episode"], old_agent.net.state_dict())
+
+                profiler.end_episode(ep)
+        finally:
+            # Whatever got appended stays readable, also when training fails
             if self.args.save_to_file:
-                if ep % 100 == 0: # change this upon necessity
-                    try:
-                        p = pickle.dumps(all_learn_data)
-                        with lzma.open(data_file_path, "wb") as f:
-                            f.write(p)
-                        del p
-
-                    except KeyboardInterrupt:
-                        # re-try the save if the user accidentally interrupted it
-                        continue
-                    #break
+                episode_log.close()
 
         end = time.time()
         print("................................ END ................................")
         print(f"\n\tTotal Time elapsed during training= {round((end - start), 2)} seconds")
+        profiler.close()
+        profiler.print_summary()
+        if evaluation is not None:
+            evaluation.close()
+            if self.args.save_to_file:
+                eval_path = self.save_folder() + "/eval_" + time.strftime("%Y%m%d_%H%M%S") + f"_exp{index}.csv"
+                save_table(evaluation.table(), eval_path)
+                print(f"Evaluation results: {eval_path}")
         print("\n.....................................................................\n")
 
-        self.plots.plot_cost(all_learn_data, self.args.episodes)
-        print("Find all polots in the Plots folder.")
-        if self.args.save_to_file:
-            print("Also find the data of current run.")
-            
-        print(f"Stats:\n\tEpisodes with success: {success_count}")
+        if self.args.export_policy:
+            # Standalone policy of the final network (TorchScript and NumPy weights)
+            paths = export_policy(self.nfq_agent.net.state_dict(), self.save_folder() + "/policy_" + time.strftime("%Y%m%d_%H%M%S") + f"_exp{index}")
+            print("Exported policy: " + ", ".join(paths))
+
+        if self.args.num_experiments == 1:
+            plot_sink.emit("cost", metrics.cost, self.args.episodes, metrics.cost_moving_average())
+        plot_sink.close()
+        print(f"Run history: {history.nbytes() / 2**20:.2f} MB for {len(history)} episodes")
+
+        return {
+            "seed": seed,
+            "time": end - start,
+            "cost": metrics.cost,
+            "success": metrics.success,
+            "length": metrics.length,
+            "loss": metrics.loss,
+            "train_epochs": episode_train_epochs,
+            "train_time": episode_train_time,
+            "pattern_size": episode_pattern_size,
+            "eval": evaluation.table() if evaluation is not None else None,
+        }
+
+def run_experiment(args, seed, index):
+    """
+    Process pool entry point, one experiment per worker process
+    """
+    torch.set_num_threads(1) # many small networks, one core each
+    return NFQMain(args).run_experiment(seed, index)
 
 def main(args):
     nfq = NFQMain(args)
     nfq.train()
 
-if __name__ == "__main__":
+def check_args(parser, args):
+    """
+    Reject flags the chosen training mode would silently ignore
+    """
+    if args.async_learner:
+        ignored = ["--" + name for name in unsupported_flags if getattr(args, name) != parser.get_default(name)]
+        if ignored:
+            parser.error("--async_learner does not support " + ", ".join(ignored))
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--env", type=str, default="Simulation", help="Choose environment: Simulation or Real")
     parser.add_argument("--data_dir", type=str, default='./Hardware_Data', help="Directory to store data hardware data, or laod data to build simulation")
+    parser.add_argument("--no_sim_cache", action="store_true", default=False, help="Rebuild the simulation from the data files instead of using the cached arrays")
     parser.add_argument("--num_experiments", type=int, default=1, help="Number of experiments to run and average results")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for running experiments in parallel (default: all cores)")
 
     #parser.add_argument("--seed", type=int, default=42, help="Random seed")
     parser.add_argument("--episodes", type=int, default=300, help="Number of episodes to train for")
     parser.add_argument("--train_max_steps", type=int, default=250, help="Number of time-steps at each training episode")
     parser.add_argument("--test_max_steps", type=int, default=300, help="Number of time-steps at each test episode")
+    parser.add_argument("--eval_every", type=int, default=0, help="Evaluate the network greedily every this many episodes in a separate process (0: off)")
+    parser.add_argument("--eval_episodes", type=int, default=100, help="Number of fixed initial positions each evaluation runs from")
+    parser.add_argument("--eval_seed", type=int, default=0, help="Seed of the evaluation positions, the same for every snapshot and run")
     
     ## 
     parser.add_argument("--agent_epochs", type=int, default=150, help="How many training epochs of patter-set for agent training")
+    parser.add_argument("--train_budget", type=float, default=None, help="Wall-clock seconds allowed for training after each episode (default: no limit)")
+    parser.add_argument("--plateau_patience", type=int, default=0, help="Stop training when the loss stops improving over this many epochs (0: off)")
+    parser.add_argument("--plateau_tol", type=float, default=1e-3, help="Relative loss improvement below which training counts as plateaued")
+    parser.add_argument("--loss_check_every", type=int, default=10, help="Epochs between loss syncs for the plateau check")
+    parser.add_argument("--pattern_cap", type=int, default=None, help="Train on at most this many transitions per episode, sampled per goal/forbidden/intermediate stratum (default: all)")
+    parser.add_argument("--recency_half_life", type=float, default=None, help="With --pattern_cap, weight transitions by age with this half-life in transitions (default: uniform)")
     parser.add_argument("--gamma", type=int, default=1.0, help="Discount factor")
+    parser.add_argument("--numpy_policy", action="store_true", default=False, help="Select actions with the NumPy evaluator instead of PyTorch")
+    parser.add_argument("--async_learner", action="store_true", default=False, help="Train in a separate learner process while the actor keeps running episodes (see NFQ_Async.py)")
+    parser.add_argument("--max_lag", type=int, default=0, help="With --async_learner, episodes the learner may fall behind before the actor waits (0: never wait)")
     parser.add_argument("--save_to_file", action="store_true", default=False, help="Save results to file")
+    parser.add_argument("--profile", action="store_true", default=False, help="Time the phases of every episode and write them to a JSONL file in profile_dir")
+    parser.add_argument("--chrome_trace", action="store_true", default=False, help="With --profile, also write a Chrome trace (chrome://tracing, ui.perfetto.dev)")
+    parser.add_argument("--profile_dir", type=str, default="./Profiles", help="Folder for profiles")
+    parser.add_argument("--export_policy", action="store_true", default=False, help="Export the final network as a TorchScript module and NumPy weights (see Utils/export_policy.py)")
+    parser.add_argument("--plots", type=str, default="process", help="How plots are rendered: process (worker process), deferred (after training), sync (in the training loop) or none")
+    parser.add_argument("--replay_dir", type=str, default=None, help="Keep the replay store in memory-mapped files in this folder, readable by other processes while training (default: in memory)")
+    parser.add_argument("--pattern_every", type=int, default=0, help="Keep the full pattern set every k episodes in the run history (0: never)")
+    parser.add_argument("--spill_dir", type=str, default=None, help="Spill retained pattern sets to .npz files in this folder instead of memory")
+    parser.add_argument("--history_budget_mb", type=float, default=None, help="Memory budget of the run history, oldest pattern sets are dropped beyond it")
 
 
     ## Args related to experiments form the paper (https://arxiv.org/pdf/2108.00138.pdf)
@@ -232,6 +362,12 @@ if __name__ == "__main__":
     parser.add_argument("--reset_freq", type=int, default=50, help="Frequency of resetting the Neural Network (Q-function approximator). Choose from  []")
     parser.add_argument("--pos_init", type=str, default="uniform", help="Choose position initialization strategy: gaussian_1, gaussian_2, uniform, linear, exponential")
     
-    main(parser.parse_args())
+    return parser
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+    main(args)
 
 # TODO: Save the terminal output to a log file, present in regressor code
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""
+Hyperparameter sweeps over the five experiments of the paper:
+num_params, hint_size, exploration, reset_freq, pos_init
+
+A sweep is a spec (JSON) with either a full grid or a number of random samples:
+    {
+        "grid": {"num_params": [39, 171], "hint_size": [1, 10]},
+        "seeds": 5,
+        "args": {"episodes": 300}
+    }
+    {
+        "random": {"num_params": [39, 61, 91, 121, 171], "hint_size": [1, 2, 5, 10, 20]},
+        "samples": 20,
+        "seeds": 3
+    }
+Every (configuration, seed) pair is a job. Jobs are run across all local cores, longest first,
+and recorded in a SQLite results store as they finish. Re-running the same command skips
+finished jobs, so a killed sweep resumes where it stopped. The output of every job goes to
+<store>_logs/<job_id>.log.
+
+Usage:
+    python NFQ_sweep.py --spec sweep.json --store sweeps/sweep.db
+    python NFQ_sweep.py --store sweeps/sweep.db --report
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import sqlite3
+import argparse
+import itertools
+import contextlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from NFQ_main import get_parser, run_experiment
+from Vehicle_Env import Simulation
+
+# All options of the five experiments (README, section 4)
+PAPER_GRID = {
+    "num_params": [39, 61, 91, 121, 171],
+    "hint_size": [1, 2, 5, 10, 20],
+    "exploration": ["no_exploration", "constant_two", "constant_ten", "linear", "exponential"],
+    "reset_freq": [1, 10, 50, 100, 1000000], # 1000000 = no reset
+    "pos_init": ["gaussian_1", "gaussian_2", "uniform", "linear", "exponential"],
+}
+
+class SweepStore:
+    """
+    Durable record of finished jobs, one row per (configuration, seed)
+    Only the scheduler process writes to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                config TEXT,
+                seed INTEGER,
+                status TEXT,
+                seconds REAL,
+                result TEXT,
+                finished REAL
+            )""")
+        self.db.commit()
+
+    def finished(self):
+        return {row[0] for row in self.db.execute("SELECT job_id FROM jobs WHERE status = 'done'")}
+
+    def durations(self):
+        """
+        Mean measured seconds per configuration, used to order new jobs
+        """
+        rows = self.db.execute("SELECT config, AVG(seconds) FROM jobs WHERE status = 'done' GROUP BY config")
+        return {config: seconds for config, seconds in rows}
+
+    def record(self, job, status, seconds, result):
+        self.db.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job["job_id"], config_key(job["config"]), job["seed"], status, seconds, json.dumps(result), time.time()))
+        self.db.commit()
+
+    def results(self):
+        rows = self.db.execute("SELECT config, seed, result FROM jobs WHERE status = 'done'")
+        return [(json.loads(config), seed, json.loads(result)) for config, seed, result in rows]
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+def expand_spec(spec):
+    """
+    List of configurations (dicts) from a grid or random spec, on top of spec["args"]
+    """
+    base = spec.get("args", {})
+    if "grid" in spec:
+        names = sorted(spec["grid"])
+        configs = [dict(zip(names, values)) for values in itertools.product(*(spec["grid"][n] for n in names))]
+    elif "random" in spec:
+        rng = random.Random(spec.get("sample_seed", 0))
+        names = sorted(spec["random"])
+        configs = []
+        seen = set()
+        space = int(np.prod([len(spec["random"][n]) for n in names]))
+        while len(configs) < min(spec["samples"], space):
+            config = {n: rng.choice(spec["random"][n]) for n in names}
+            if config_key(config) not in seen:
+                seen.add(config_key(config))
+                configs.append(config)
+    else:
+        raise ValueError("Sweep spec needs a 'grid' or a 'random' section")
+    return [{**base, **config} for config in configs]
+
+def make_jobs(spec):
+    # Seeds are derived from the sweep seed, so a resumed sweep regenerates the same jobs
+    seed_rng = random.Random(spec.get("seed", 0))
+    seeds = [seed_rng.randint(0, 1000000) for _ in range(spec.get("seeds", 1))]
+    jobs = []
+    for config in expand_spec(spec):
+        for seed in seeds:
+            job_id = hashlib.sha256(f"{config_key(config)}|{seed}".encode()).hexdigest()[:16]
+            jobs.append({"job_id": job_id, "config": config, "seed": seed})
+    return jobs
+
+def job_args(config, defaults):
+    args = argparse.Namespace(**vars(defaults))
+    for name, value in config.items():
+        if not hasattr(args, name):
+            raise ValueError(f"Unknown argument in sweep spec: {name}")
+        setattr(args, name, value)
+    return args
+
+def estimated_cost(args):
+    """
+    Relative run time of a configuration. Each episode trains agent_epochs passes over every
+    transition so far (plus hints), so cost grows with episodes^2, episode length and network size.
+    """
+    transitions = args.episodes * (args.episodes + 1) / 2 * args.train_max_steps
+    return transitions * (1 + args.hint_size / 100) * args.agent_epochs * args.num_params
+
+def order_jobs(jobs, defaults, durations):
+    """
+    Longest first: measured time of the same configuration if known, else the cost model,
+    scaled to seconds by the measured jobs.
+    """
+    estimates = [estimated_cost(job_args(job["config"], defaults)) for job in jobs]
+    known = [(durations[config_key(job["config"])], e) for job, e in zip(jobs, estimates) if config_key(job["config"]) in durations]
+    scale = sum(d for d, _ in known) / sum(e for _, e in known) if known else 1.0
+
+    def expected(i):
+        return durations.get(config_key(jobs[i]["config"]), estimates[i] * scale)
+
+    order = sorted(range(len(jobs)), key=expected, reverse=True)
+    return [jobs[i] for i in order]
+
+def run_job(args, seed, log_path):
+    """
+    Worker entry point, output of the run goes to a log file instead of the terminal
+    """
+    start = time.time()
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log):
+        result = run_experiment(args, seed, 0)
+    return time.time() - start, {key: (value.tolist() if isinstance(value, np.ndarray) else value) for key, value in result.items()}
+
+def run_sweep(spec, store, workers=None, dry_run=False):
+    defaults = get_parser().parse_args([])
+    jobs = make_jobs(spec)
+    finished = store.finished()
+    pending = order_jobs([job for job in jobs if job["job_id"] not in finished], defaults, store.durations())
+    print(f"Sweep: {len(jobs)} jobs, {len(jobs) - len(pending)} already finished, {len(pending)} to run")
+    if dry_run or not pending:
+        for job in pending:
+            print("\t", job["seed"], job["config"])
+        return
+
+    # Build the simulation once so that workers load the cached arrays
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        Simulation().build(defaults.data_dir)
+
+    log_dir = os.path.splitext(store.path)[0] + "_logs"
+    os.makedirs(log_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    context = multiprocessing.get_context("spawn")
+    start = time.time()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {}
+        for job in pending:
+            args = job_args(job["config"], defaults)
+            args.plots = "none" # the results store holds the outcome
+            futures[pool.submit(run_job, args, job["seed"], os.path.join(log_dir, job["job_id"] + ".log"))] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            done += 1
+            try:
+                seconds, result = future.result()
+                store.record(job, "done", seconds, result)
+                print(f"[{done}/{len(pending)}] {seconds:7.1f}s success: {int(sum(result['success']))} {job['config']} seed={job['seed']}")
+            except Exception as e:
+                store.record(job, "failed", 0.0, {"error": repr(e)})
+                print(f"[{done}/{len(pending)}] FAILED {job['config']} seed={job['seed']}: {e!r}, log: {os.path.join(log_dir, job['job_id'] + '.log')}")
+
+    print(f"Sweep finished in {round(time.time() - start, 2)} seconds")
+
+def report(store, last=10):
+    """
+    Mean over seeds of the cost and success rate of the last episodes, per configuration
+    """
+    by_config = {}
+    for config, seed, result in store.results():
+        by_config.setdefault(config_key(config), []).append(result)
+
+    rows = []
+    for key, results in by_config.items():
+        cost = np.mean([np.mean(r["cost"][-last:]) for r in results])
+        success = np.mean([np.mean(r["success"][-last:]) for r in results])
+        rows.append((cost, success, len(results), key))
+
+    print(f"{'cost':>8s} {'success':>8s} {'seeds':>5s}  configuration (last {last} episodes)")
+    for cost, success, seeds, key in sorted(rows):
+        print(f"{cost:8.4f} {success:8.2f} {seeds:5d}  {key}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spec", type=str, default=None, help="Sweep spec (JSON file). Default: full grid over the five paper experiments")
+    parser.add_argument("--seeds", type=int, default=None, help="Seeds per configuration (overrides the spec)")
+    parser.add_argument("--store", type=str, default="./Sweeps/sweep.db", help="SQLite results store, re-use it to resume a sweep")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("--dry_run", action="store_true", default=False, help="Only list the jobs that would run")
+    parser.add_argument("--report", action="store_true", default=False, help="Summarise finished jobs instead of running")
+    args = parser.parse_args()
+
+    store = SweepStore(args.store)
+    if args.report:
+        report(store)
+        sys.exit()
+
+    if args.spec is None:
+        spec = {"grid": PAPER_GRID, "seeds": 1}
+    else:
+        with open(args.spec) as f:
+            spec = json.load(f)
+    if args.seeds is not None:
+        spec["seeds"] = args.seeds
+
+    run_sweep(spec, store, args.workers, args.dry_run)
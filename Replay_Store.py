@@ -0,0 +1,229 @@
+"""
+Replay store for NFQ transitions.
+
+NFQ re-learns from every transition collected so far after each episode.
+Instead of rebuilding arrays from the whole list of experiences every time,
+new transitions are appended into preallocated float32 tensors that grow geometrically,
+and the pattern set is computed from views of them.
+
+MappedReplayStore keeps the same tensors as views of a memory-mapped file instead, so the
+transitions survive a crash, runs can outgrow RAM and other processes can read a live run.
+"""
+import os
+import json
+import numpy as np
+import torch
+
+class ReplayStore:
+    """
+    Tensors are laid out so the network inputs need no concatenation:
+        state_action:      (capacity, 4)    = (*state, action)
+        next_state_action: (capacity, 2, 4) = (*next_state, 0) and (*next_state, 1)
+        cost, done:        (capacity,)
+        episode:           (capacity,) int32, the episode a transition came from (-1: not given)
+    Only the first len(self) rows are valid.
+    """
+    def __init__(self, capacity=1024, state_dim=3):
+        self.state_dim = state_dim
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        d = self.state_dim
+        state_action = torch.zeros(capacity, d + 1)
+        next_state_action = torch.zeros(capacity, 2, d + 1)
+        next_state_action[:, 1, d] = 1
+        cost = torch.zeros(capacity)
+        done = torch.zeros(capacity)
+        episode = torch.full((capacity,), -1, dtype=torch.int32)
+
+        # Copy over what is already stored
+        if self.size:
+            state_action[:self.size] = self.state_action_t[:self.size]
+            next_state_action[:self.size] = self.next_state_action_t[:self.size]
+            cost[:self.size] = self.cost_t[:self.size]
+            done[:self.size] = self.done_t[:self.size]
+            episode[:self.size] = self.episode_t[:self.size]
+
+        self.state_action_t = state_action
+        self.next_state_action_t = next_state_action
+        self.cost_t = cost
+        self.done_t = done
+        self.episode_t = episode
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, experiences, episode=-1):
+        """
+        Append a list of (state, action, cost, next_state, done) tuples, e.g. one episode
+        """
+        if len(experiences) == 0:
+            return
+        self.extend_arrays(*zip(*experiences), episode=episode)
+
+    def extend_arrays(self, states, actions, costs, next_states, dones, episode=-1):
+        """
+        Append transitions given as arrays (e.g. from BatchSteerboxNFQ.rollout)
+        """
+        n = len(states)
+        if n == 0:
+            return
+        if self.size + n > self.capacity:
+            capacity = self.capacity
+            while self.size + n > capacity:
+                capacity *= 2
+            self.allocate(capacity)
+
+        d = self.state_dim
+        rows = slice(self.size, self.size + n)
+
+        self.state_action_t[rows, :d] = torch.from_numpy(np.array(states, dtype=np.float32))
+        self.state_action_t[rows, d] = torch.from_numpy(np.array(actions, dtype=np.float32))
+        next_states = torch.from_numpy(np.array(next_states, dtype=np.float32))
+        self.next_state_action_t[rows, 0, :d] = next_states
+        self.next_state_action_t[rows, 1, :d] = next_states
+        self.cost_t[rows] = torch.from_numpy(np.array(costs, dtype=np.float32))
+        self.done_t[rows] = torch.from_numpy(np.array(dones, dtype=np.float32))
+        self.episode_t[rows] = episode
+        self.size += n
+
+    # Views over the valid rows, no copies
+    @property
+    def state_action(self):
+        return self.state_action_t[:self.size]
+
+    @property
+    def next_state_action(self):
+        return self.next_state_action_t[:self.size]
+
+    @property
+    def state(self):
+        return self.state_action_t[:self.size, :self.state_dim]
+
+    @property
+    def action(self):
+        return self.state_action_t[:self.size, self.state_dim]
+
+    @property
+    def next_state(self):
+        return self.next_state_action_t[:self.size, 0, :self.state_dim]
+
+    @property
+    def cost(self):
+        return self.cost_t[:self.size]
+
+    @property
+    def done(self):
+        return self.done_t[:self.size]
+
+    @property
+    def episode(self):
+        return self.episode_t[:self.size]
+
+# One transition on disk: the network inputs laid out as in ReplayStore, next_state is
+# next_state_action[0, :3]. All fields are 4 bytes wide, so the file reads as a (rows, 15)
+# float32 matrix and every tensor of ReplayStore is a strided view of it
+replay_dtype = np.dtype([
+    ("state", np.float32, 3),
+    ("action", np.float32),
+    ("next_state_action", np.float32, (2, 4)),
+    ("cost", np.float32),
+    ("done", np.float32),
+    ("episode", np.int32),
+])
+
+class MappedReplayStore(ReplayStore):
+    """
+    ReplayStore on a memory-mapped file of replay_dtype records in the folder path:
+        replay.dat  the records, grown by whole segments of rows
+        meta.json   number of valid rows, written on opening and rewritten (atomically) after new rows are flushed
+    Growing maps the longer file again, nothing is copied. Opening an existing folder continues it.
+
+    With readonly=True the file is mapped copy-on-write: the tensors share the page cache of the
+    writer without copies, refresh() picks up what it has appended since.
+    """
+    def __init__(self, path, readonly=False, segment=65536):
+        self.path = path
+        self.data_path = os.path.join(path, "replay.dat")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.readonly = readonly
+        self.segment = segment
+        self.state_dim = 3
+        self.size = 0
+        self.capacity = 0
+
+        if readonly:
+            # Empty until the writer's meta.json exists
+            super().allocate(0)
+            self.refresh()
+            return
+        os.makedirs(path, exist_ok=True)
+        capacity = segment
+        if os.path.exists(self.meta_path):
+            meta = self.read_meta()
+            self.size = meta["size"]
+            capacity = max(capacity, meta["capacity"])
+        self.allocate(capacity)
+        # Readers can open the store before the first transition
+        self.write_meta()
+
+    def read_meta(self):
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if np.dtype([tuple(field) for field in meta["dtype"]]) != replay_dtype:
+            raise ValueError(f"{self.data_path} holds another record layout")
+        return meta
+
+    def write_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self.size, "capacity": self.capacity, "dtype": replay_dtype.descr}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def allocate(self, capacity):
+        # Whole segments, the file only ever grows
+        capacity = -(-capacity // self.segment) * self.segment
+        if not self.readonly:
+            with open(self.data_path, "ab") as f:
+                if f.tell() < capacity * replay_dtype.itemsize:
+                    f.truncate(capacity * replay_dtype.itemsize)
+        self.map(capacity)
+        if not self.readonly:
+            # Action flag of the (*next_state, 1) input, for the rows that are new
+            self.next_state_action_t[self.size:, 1, self.state_dim] = 1
+
+    def map(self, capacity):
+        self.records = np.memmap(self.data_path, dtype=replay_dtype, mode="c" if self.readonly else "r+", shape=(capacity,))
+        table = torch.from_numpy(np.asarray(self.records).view(np.float32).reshape(capacity, replay_dtype.itemsize // 4))
+        self.state_action_t = table[:, 0:4]
+        self.next_state_action_t = table[:, 4:12].unflatten(1, (2, 4))
+        self.cost_t = table[:, 12]
+        self.done_t = table[:, 13]
+        self.episode_t = torch.from_numpy(np.asarray(self.records["episode"]))
+        self.capacity = capacity
+
+    def extend_arrays(self, states, actions, costs, next_states, dones, episode=-1):
+        if self.readonly:
+            raise ValueError("replay store is opened read-only")
+        super().extend_arrays(states, actions, costs, next_states, dones, episode)
+        # Rows first, then the count that makes them visible
+        self.records.flush()
+        self.write_meta()
+
+    def refresh(self):
+        """
+        Read-only: see the rows appended by the writer since opening (or the last refresh)
+        """
+        if not os.path.exists(self.meta_path):
+            # The writer has not started yet
+            return self.size
+        meta = self.read_meta()
+        if meta["capacity"] != self.capacity:
+            self.map(meta["capacity"])
+        self.size = meta["size"]
+        return self.size
+
+    def nbytes(self):
+        return self.size * replay_dtype.itemsize
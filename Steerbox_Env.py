@@ -100,4 +100,126 @@ class SteerboxEnv:
             sys.exit(0) 
         
     def close(self):
-        print("Closed")
\ No newline at end of file
+        print("Closed")
+
+class BatchSteerboxEnv:
+    """
+    Runs N independent simulated episodes in lockstep.
+    States are kept as an (N, 3) array of (pos, vel, voltage), same semantics as SteerboxEnv.
+    """
+    def __init__(self, env):
+        self.state = None
+        self.last_voltage = None
+        self.env = env
+
+    # Same 5 strategies as SteerboxEnv, but draw n positions at once
+    def position_gaussian_1(self, n, epoch_no, epochs):
+        return np.clip(np.random.normal(0, 0.15, n), -0.5, 0.5)
+
+    def position_gaussian_2(self, n, epoch_no, epochs):
+        return np.clip(np.random.normal(0, 0.3, n), -0.5, 0.5)
+
+    def position_uniform(self, n, epoch_no, epochs):
+        return ((2*np.random.random(n))-1)*0.5
+
+    def increment_position_linearly(self, n, epoch_no, epochs):
+        epoch_no = epoch_no + 1 # starts at 0
+        end_pos = 0.5
+        limit = (end_pos/epochs) * epoch_no
+        return ((2*np.random.random(n))-1)*limit
+
+    def increment_position_exponentially(self, n, epoch_no, epochs):
+        epoch_no = epoch_no + 1 # starts at 0
+        end_pos = 0.5
+        limit = np.min([end_pos, np.exp(epoch_no)/(0.5*np.exp(200))])
+        return ((2*np.random.random(n))-1)*limit
+
+    def reset(self, n, epoch_no, epochs, position_init_method):
+
+        position_init_func = {
+            "gaussian_1": self.position_gaussian_1,
+            "gaussian_2": self.position_gaussian_2,
+            "uniform": self.position_uniform,
+            "linear": self.increment_position_linearly,
+            "exponential": self.increment_position_exponentially
+        }
+
+        if position_init_method not in position_init_func:
+            raise ValueError("Invalid position_init_method. Available options are: gaussian_1, gaussian_2, uniform, linear, exponential")
+
+        pos = position_init_func[position_init_method](n, epoch_no, epochs)
+        return self.reset_to(pos)
+
+    def reset_to(self, positions):
+        """
+        Start each episode from the given wheel positions (e.g. a fixed evaluation set)
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        self.state = np.zeros((len(positions), 3))
+        self.state[:, 0] = positions
+        self.last_voltage = np.zeros(len(positions))
+        return self.state.copy()
+
+    def step(self, actions, active=None):
+        """
+        Step every episode where active is True, the rest keep their state.
+        actions has one entry per active episode.
+        """
+        if active is None:
+            active = np.ones(len(self.state), dtype=bool)
+
+        actions = np.asarray(actions)
+        next_state = self.env.query_batch(self.state[active], actions)
+
+        # Same ordering as SteerboxEnv.step: the state carries the voltage before this action
+        self.state[active, 0] = next_state[:, 0]
+        self.state[active, 1] = next_state[:, 1]
+        self.state[active, 2] = self.last_voltage[active]
+
+        dv = np.where(actions == 0, -0.1, 0.1)
+        self.last_voltage[active] = np.clip(self.last_voltage[active] + dv, -1, 1)
+
+        return self.state[active].copy()
+
+    def close(self):
+        print("Closed")
+
+
+class CompiledBatchSteerboxEnv(BatchSteerboxEnv):
+    """
+    BatchSteerboxEnv on top of a CompiledSimulation: after the first step each episode is tracked
+    as (row, voltage index) and stepping is a table lookup. States are identical to BatchSteerboxEnv.
+    """
+    def reset_to(self, positions):
+        state = super().reset_to(positions)
+        n = len(state)
+        self.rows = np.full(n, -1, dtype=np.int64) # -1: still at the reset state, not a table row
+        self.state_voltage = np.full(n, self.env.zero_voltage, dtype=np.int64)
+        self.last_voltage_id = np.full(n, self.env.zero_voltage, dtype=np.int64)
+        return state
+
+    def step(self, actions, active=None):
+        if active is None:
+            active = np.ones(len(self.state), dtype=bool)
+
+        actions = np.asarray(actions)
+        idx = np.flatnonzero(active)
+        rows = self.rows[idx]
+
+        # Episodes on their first step need a tree query, the rest are lookups
+        first = rows < 0
+        next_rows = np.empty(len(idx), dtype=np.int64)
+        if first.any():
+            next_rows[first] = self.env.query_rows(self.state[idx[first]], actions[first])
+        if (~first).any():
+            next_rows[~first] = self.env.next_rows(rows[~first], self.state_voltage[idx[~first]], actions[~first])
+
+        self.rows[idx] = next_rows
+        self.state_voltage[idx] = self.last_voltage_id[idx]
+        self.last_voltage_id[idx] = self.env.next_voltage[self.last_voltage_id[idx], actions]
+
+        self.state[idx, :2] = self.env.next_states[next_rows, :2]
+        self.state[idx, 2] = self.env.voltages[self.state_voltage[idx]]
+        self.last_voltage[idx] = self.env.voltages[self.last_voltage_id[idx]]
+
+        return self.state[idx].copy()
@@ -6,13 +6,12 @@ Major things defined here:
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import torch
 
-from Utils.plots import Plots
+from Utils.plot_sinks import SyncPlotSink
 
 class SteerboxNFQ:
-    def __init__(self, env):
+    def __init__(self, env, plot_sink=None):
         self.env = env
 
         # NFQ relies on defined success (goal), forbidden (failure) and states between them
@@ -24,7 +23,9 @@ class SteerboxNFQ:
         # Minimum time control problem has a step cost
         # A penalty, when it neither succeeds nor fails
         self.step_cost = 0.001
-        self.success_plot = Plots()
+
+        # Successful episodes are handed to a plot sink (Utils.plot_sinks), rendered right away by default
+        self.plot_sink = plot_sink if plot_sink is not None else SyncPlotSink()
 
     def reset(self, epoch_no, epochs, position_init_method):
         # Reset the environment and return the initial state
@@ -57,6 +58,14 @@ class SteerboxNFQ:
     def close(self):
         self.env.close()
 
+    def goal_and_forbidden(self, pos, vel):
+        """
+        Boolean masks of the goal and forbidden states among arrays of positions and velocities
+        """
+        forbidden = (pos > self.pos_failure) | (pos < -self.pos_failure) | (vel > self.vel_failure) | (vel < -self.vel_failure)
+        goal = ~forbidden & (-self.pos_success < pos) & (pos < self.pos_success) & (-self.vel_success < vel) & (vel < self.vel_success)
+        return goal, forbidden
+
     def experience(self, get_best_action, max_steps, epoch_no, epochs, position_init_method):
         state = self.reset(epoch_no, epochs, position_init_method)
         experiences = []
@@ -85,7 +94,7 @@ class SteerboxNFQ:
                 break 
         
         if success_indicator ==1:
-            self.success_plot.plot_success(experiences, max_steps, epoch_no)
+            self.plot_sink.emit("success", np.array([e[0] for e in experiences]), max_steps, epoch_no)
             
         return success_indicator, experiences, total_cost
     
@@ -94,12 +103,214 @@ class SteerboxNFQ:
         Artifically generate experiences in the region where the agent is likely to succeed, to help the network learn during early stages.
         Such transitions have a cost of 0
         """
-        goal_state_action_b = [np.array([
-            np.random.uniform(-self.pos_success, self.pos_success),
-            np.random.uniform(-self.vel_success, self.vel_success),
-            np.random.uniform(-0.2, 0.2), # change in voltage, this range is chosen  empirically
-            np.random.randint(2), # Action at random
-            ]) for _ in range(size)]
+        size = max(0, size)
+        goal_state_action_b = np.column_stack([
+            np.random.uniform(-self.pos_success, self.pos_success, size),
+            np.random.uniform(-self.vel_success, self.vel_success, size),
+            np.random.uniform(-0.2, 0.2, size), # change in voltage, this range is chosen  empirically
+            np.random.randint(2, size=size), # Action at random
+            ])
 
         goal_target_q_values = np.zeros(size)
-        return goal_state_action_b, goal_target_q_values
\ No newline at end of file
+        return goal_state_action_b, goal_target_q_values
+
+
+class HintToGoal:
+    """
+    Hint-to-goal pattern set kept at hint_size % of the number of collected transitions.
+    Samples are drawn (vectorized) only to top up the difference, into a preallocated tensor
+    that grows geometrically, and handed out as views: nothing is re-converted per episode.
+    """
+    def __init__(self, nfq_env, hint_size, capacity=64):
+        self.nfq_env = nfq_env
+        self.hint_size = hint_size
+        self.size = 0
+        self.state_action = torch.zeros(capacity, 4)
+        self.target_q_values = torch.zeros(capacity) # goal transitions have a cost of 0
+
+    def target_size(self, n_transitions):
+        return int(np.ceil(self.hint_size / 100 * n_transitions))
+
+    def top_up(self, n_transitions):
+        """
+        Returns (state_action_b, target_q_values) views with hint_size % of n_transitions rows
+        """
+        target = self.target_size(n_transitions)
+        if target > self.size:
+            if target > len(self.state_action):
+                capacity = len(self.state_action)
+                while capacity < target:
+                    capacity *= 2
+                state_action = torch.zeros(capacity, 4)
+                state_action[:self.size] = self.state_action[:self.size]
+                self.state_action = state_action
+                self.target_q_values = torch.zeros(capacity)
+
+            new_state_action_b, _ = self.nfq_env.generate_goal_pattern_set(size=target - self.size)
+            self.state_action[self.size:target] = torch.from_numpy(new_state_action_b.astype(np.float32))
+            self.size = target
+
+        return self.state_action[:target], self.target_q_values[:target]
+
+
+class PatternSetSampler:
+    """
+    Caps the pattern set for long runs: at most cap transitions are trained on per episode.
+    They are drawn per stratum of the next state (goal, forbidden, intermediate by the SteerboxNFQ
+    thresholds) so the rare goal and forbidden transitions keep their share of the cap, and
+    recent transitions are favoured with a half_life in transitions (None: uniform).
+    Transitions are labelled once, when they are new.
+    """
+    strata = ("goal", "forbidden", "intermediate")
+
+    def __init__(self, nfq_env, cap, half_life=None, shares=(0.25, 0.25, 0.5)):
+        self.nfq_env = nfq_env
+        self.cap = cap
+        self.half_life = half_life
+        self.shares = np.asarray(shares, dtype=np.float64)
+        self.labels = np.zeros(1024, dtype=np.int8)
+        self.size = 0
+        self.counts = dict.fromkeys(self.strata, 0) # transitions of each stratum used by the last sample
+
+    def label(self, replay):
+        n = len(replay)
+        if n > len(self.labels):
+            labels = np.zeros(max(n, 2 * len(self.labels)), dtype=np.int8)
+            labels[:self.size] = self.labels[:self.size]
+            self.labels = labels
+        next_state = replay.next_state[self.size:n].numpy()
+        goal, forbidden = self.nfq_env.goal_and_forbidden(next_state[:, 0], next_state[:, 1])
+        self.labels[self.size:n] = np.where(goal, 0, np.where(forbidden, 1, 2))
+        self.size = n
+
+    def allocate(self, sizes):
+        """
+        Split the cap by the shares, what a small stratum cannot fill goes to the others
+        """
+        quotas = np.zeros(len(sizes), dtype=np.int64)
+        while True:
+            left = self.cap - quotas.sum()
+            free = sizes - quotas
+            if left <= 0 or not free.any():
+                return quotas
+            shares = self.shares * (free > 0)
+            add = np.minimum(np.floor(left * shares / shares.sum()).astype(np.int64), free)
+            if not add.any():
+                k = np.argmax(shares)
+                add[k] = min(left, free[k])
+            quotas += add
+
+    def pick(self, members, size, n):
+        if size >= len(members):
+            return members
+        if self.half_life is None:
+            return np.random.choice(members, size, replace=False)
+        weights = np.maximum(np.exp2((members - (n - 1)) / self.half_life), 1e-12)
+        return np.random.choice(members, size, replace=False, p=weights / weights.sum())
+
+    def sample(self, replay):
+        """
+        Sorted indices into the replay store, or None when everything fits under the cap
+        """
+        self.label(replay)
+        n = len(replay)
+        labels = self.labels[:n]
+        members = [np.flatnonzero(labels == k) for k in range(len(self.strata))]
+        if self.cap is None or n <= self.cap:
+            self.counts = {name: len(m) for name, m in zip(self.strata, members)}
+            return None
+
+        quotas = self.allocate(np.array([len(m) for m in members]))
+        self.counts = {name: int(q) for name, q in zip(self.strata, quotas)}
+        indices = np.concatenate([self.pick(m, q, n) for m, q in zip(members, quotas)])
+        return torch.from_numpy(np.sort(indices))
+
+
+class BatchSteerboxNFQ(SteerboxNFQ):
+    """
+    Same reward function as SteerboxNFQ, applied as array operations over N episodes (see BatchSteerboxEnv).
+    """
+    def reset(self, n, epoch_no, epochs, position_init_method):
+        return self.env.reset(n, epoch_no, epochs, position_init_method)
+
+    def step(self, actions, active=None):
+        state = self.env.step(actions, active)
+        pos, vel, voltage = state[:, 0], state[:, 1], state[:, 2]
+
+        # Goal and forbidden states
+        goal, failed = self.goal_and_forbidden(pos, vel)
+
+        # Neither, rotating away from the center costs double
+        cost = np.full(len(state), self.step_cost)
+        away = ((pos > 0) & (voltage > 0)) | ((pos < 0) & (voltage < 0))
+        cost[away] *= 2
+        cost[goal] = 0
+        cost[failed] = 1
+
+        return state, cost, failed
+
+    def rollout(self, get_best_actions, max_steps, states, pass_index=False):
+        """
+        Run all episodes from the current (already reset) states until each fails or reaches max_steps.
+        get_best_actions maps an (M, 3) array of states to M actions.
+        With pass_index, it also receives the episode indices of the M states (e.g. one agent per episode).
+
+        Returns arrays indexed [step, episode]; entries past an episode's length are unused.
+        """
+        n = len(states)
+        all_states = np.zeros((max_steps, n, 3))
+        all_actions = np.zeros((max_steps, n), dtype=np.int64)
+        all_costs = np.zeros((max_steps, n))
+        all_next_states = np.zeros((max_steps, n, 3))
+        all_failed = np.zeros((max_steps, n), dtype=bool)
+
+        lengths = np.zeros(n, dtype=np.int64)
+        active = np.ones(n, dtype=bool)
+        state = np.array(states, dtype=np.float64)
+
+        for step in range(max_steps):
+            idx = np.flatnonzero(active)
+            actions = np.asarray(get_best_actions(state[idx], idx) if pass_index else get_best_actions(state[idx]))
+            next_state, cost, failed = self.step(actions, active)
+
+            all_states[step, idx] = state[idx]
+            all_actions[step, idx] = actions
+            all_costs[step, idx] = cost
+            all_next_states[step, idx] = next_state
+            all_failed[step, idx] = failed
+
+            state[idx] = next_state
+            lengths[idx] += 1
+            active[idx[failed]] = False
+            if not active.any():
+                break
+
+        # Same success criteria as SteerboxNFQ.experience: survived every step and ended in the goal region
+        final = all_next_states[max_steps-1]
+        success = (lengths == max_steps) & (-0.05 < final[:, 0]) & (final[:, 0] < 0.05) & (-0.01 < final[:, 1]) & (final[:, 1] < 0.01)
+
+        return success, (all_states, all_actions, all_costs, all_next_states, all_failed), lengths
+
+    def experience(self, get_best_actions, max_steps, epoch_no, epochs, position_init_method, n):
+        """
+        Batched counterpart of SteerboxNFQ.experience for n episodes.
+        Returns per-episode success indicators, lists of (state, action, cost, next_state, failed) and total costs.
+        Success plots are not drawn here, this is meant for bulk collection.
+        """
+        states = self.reset(n, epoch_no, epochs, position_init_method)
+        success, arrays, lengths = self.rollout(get_best_actions, max_steps, states)
+        all_states, all_actions, all_costs, all_next_states, all_failed = arrays
+
+        experiences = []
+        for i in range(n):
+            length = lengths[i]
+            experiences.append(list(zip(
+                all_states[:length, i],
+                all_actions[:length, i].tolist(),
+                all_costs[:length, i].tolist(),
+                all_next_states[:length, i],
+                all_failed[:length, i].tolist(),
+            )))
+
+        total_cost = np.array([sum(all_costs[:lengths[i], i].tolist(), 0.0) for i in range(n)])
+        return success.astype(int), experiences, total_cost
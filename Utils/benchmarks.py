@@ -0,0 +1,390 @@
+"""
+Benchmarks for the simulation, the agent and the end to end training loop.
+
+    build        Simulation.build from the data files and from the cache
+    query        Simulation.query and query_batch throughput
+    simulation   KDTree against compiled transition table rollouts
+    actions      get_best_action: legacy, torch and numpy paths
+    latency      get_best_action mean and p99 per network size, against the 50 ms control budget
+    pattern_set  generate_pattern_set and train against the number of transitions
+    end_to_end   episodes per second of NFQMain
+
+Seeds are fixed. Results are written as JSON with machine metadata and can be compared
+against an earlier run; the exit code is 1 if a timing regressed beyond the threshold.
+
+Run from the repository root:
+    python -m Utils.benchmarks --output bench.json
+    python -m Utils.benchmarks --bench query,latency --baseline bench.json --threshold 0.2
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import contextlib
+import numpy as np
+import torch
+
+from NFQ_Agent import NFQAgent
+from Replay_Store import ReplayStore
+from Vehicle_Env import Simulation, CompiledSimulation
+from Steerbox_Env import SteerboxEnv, BatchSteerboxEnv, CompiledBatchSteerboxEnv
+
+def build_simulation(data_dir):
+    # Simulation.build is chatty, keep benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim = Simulation()
+        sim.build(data_dir)
+    return sim
+
+def rollout_scalar(sim, positions, actions):
+    """
+    The per-step KDTree path: one Simulation.query per step, one episode at a time
+    """
+    env = SteerboxEnv(sim, env_type='simulation')
+    max_steps, n = actions.shape
+    states = np.zeros((max_steps, n, 3))
+    for i in range(n):
+        env.state = (positions[i], 0, 0)
+        env.last_voltage = 0
+        for step in range(max_steps):
+            states[step, i] = env.step(actions[step, i])
+    return states
+
+def rollout_batch(env, positions, actions):
+    max_steps, n = actions.shape
+    states = np.zeros((max_steps, n, 3))
+    env.reset_to(positions)
+    for step in range(max_steps):
+        states[step] = env.step(actions[step])
+    return states
+
+def benchmark_compiled(sim, episodes=100, max_steps=250, seed=0):
+    """
+    Per-step time of the KDTree path against the compiled table, on the same random action sequences.
+    All paths must produce bit-identical states.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-0.5, 0.5, episodes)
+    actions = rng.integers(0, 2, size=(max_steps, episodes))
+    steps = episodes * max_steps
+    results = {}
+
+    start = time.perf_counter()
+    reference = rollout_scalar(sim, positions, actions)
+    results["kdtree_scalar"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    states = rollout_batch(BatchSteerboxEnv(sim), positions, actions)
+    results["kdtree_batch"] = time.perf_counter() - start
+    assert np.array_equal(states, reference), "batched KDTree path differs from Simulation.query"
+
+    # Lazily filled table, first use pays for the tree queries
+    start = time.perf_counter()
+    states = rollout_batch(CompiledBatchSteerboxEnv(CompiledSimulation(sim, use_cache=False)), positions, actions)
+    results["compiled_lazy"] = time.perf_counter() - start
+    assert np.array_equal(states, reference), "lazily compiled path differs from Simulation.query"
+
+    start = time.perf_counter()
+    compiled = CompiledSimulation(sim, use_cache=False)
+    compiled.precompute()
+    results["compile"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    states = rollout_batch(CompiledBatchSteerboxEnv(compiled), positions, actions)
+    results["compiled_batch"] = time.perf_counter() - start
+    assert np.array_equal(states, reference), "compiled path differs from Simulation.query"
+
+    print(f"Simulation steps: {steps} ({episodes} episodes x {max_steps} steps), results bit-identical")
+    print(f"\tCompile (full table): {results['compile']:.2f} s")
+    for name in ("kdtree_scalar", "kdtree_batch", "compiled_lazy", "compiled_batch"):
+        per_step = 1e6 * results[name] / steps
+        speedup = results["kdtree_scalar"] / results[name]
+        print(f"\t{name:16s} {per_step:8.3f} us/step  ({speedup:.1f}x)")
+    return results
+
+def legacy_best_action(net, state):
+    """
+    Action selection as it was before the single pass path, kept for comparison
+    """
+    q_left = net(torch.cat([torch.FloatTensor(state), torch.FloatTensor([0])], dim=0))
+    q_right = net(torch.cat([torch.FloatTensor(state), torch.FloatTensor([1])], dim=0))
+    return 1 if q_left >= q_right else 0
+
+def time_per_call(func, states):
+    start = time.perf_counter()
+    for state in states:
+        func(state)
+    return 1e6 * (time.perf_counter() - start) / len(states)
+
+def benchmark_action_selection(param_counts=(39, 61, 91, 121, 171), iterations=20000, seed=0):
+    """
+    Per-call latency (microseconds) of NFQAgent.get_best_action for each network size
+    """
+    rng = np.random.default_rng(seed)
+    states = rng.uniform(-0.5, 0.5, size=(iterations, 3))
+    results = {}
+
+    print(f"Action selection latency, {iterations} calls (us/call)")
+    print(f"\t{'params':>6s} {'legacy':>8s} {'torch':>8s} {'numpy':>8s}  numpy/torch action mismatch")
+    for param_count in param_counts:
+        torch.manual_seed(seed)
+        agent = NFQAgent(argparse.Namespace(num_params=param_count, numpy_policy=False))
+        numpy_agent = NFQAgent(argparse.Namespace(num_params=param_count, numpy_policy=True))
+        numpy_agent.net.load_state_dict(agent.net.state_dict())
+        numpy_agent.sync_numpy_policy()
+
+        # Both paths must agree with the old one
+        legacy_actions = [legacy_best_action(agent.net, state) for state in states[:1000]]
+        assert legacy_actions == [agent.get_best_action(state) for state in states[:1000]]
+        mismatch = np.mean(np.array(legacy_actions) != [numpy_agent.get_best_action(state) for state in states[:1000]])
+
+        row = {
+            "legacy": time_per_call(lambda state: legacy_best_action(agent.net, state), states),
+            "torch": time_per_call(agent.get_best_action, states),
+            "numpy": time_per_call(numpy_agent.get_best_action, states),
+            "numpy_mismatch": float(mismatch),
+        }
+        results[param_count] = row
+        print(f"\t{param_count:6d} {row['legacy']:8.2f} {row['torch']:8.2f} {row['numpy']:8.2f}  {100*mismatch:.2f}%")
+    return results
+
+def latency_percentiles(func, states):
+    """
+    Mean and 99th percentile (microseconds) of single calls
+    """
+    times = np.zeros(len(states))
+    for i, state in enumerate(states):
+        start = time.perf_counter()
+        func(state)
+        times[i] = time.perf_counter() - start
+    return 1e6 * times.mean(), 1e6 * np.percentile(times, 99)
+
+def best_time(func, repeat=3):
+    """
+    Fastest of repeat runs (seconds), the least disturbed by other load on the machine
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark_build(data_dir, cold=True):
+    """
+    Simulation.build from the data files (cold) and from the cached arrays (warm)
+    """
+    results = {}
+    if cold:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            Simulation().build(data_dir, use_cache=False)
+        results["cold_s"] = time.perf_counter() - start
+
+    build_simulation(data_dir) # make sure the cache exists
+    start = time.perf_counter()
+    build_simulation(data_dir)
+    results["warm_s"] = time.perf_counter() - start
+
+    print("Simulation.build: " + ", ".join(f"{name} {value:.3f} s" for name, value in results.items()))
+    return results
+
+def benchmark_query(sim, queries=20000, seed=0, repeat=3):
+    """
+    Simulation.query throughput, one call per state, and query_batch over all states at once
+    """
+    rng = np.random.default_rng(seed)
+    states = np.column_stack([rng.uniform(-0.5, 0.5, queries), rng.uniform(-0.04, 0.04, queries), rng.uniform(-1, 1, queries)])
+    actions = rng.integers(0, 2, size=queries)
+
+    def query_all():
+        for state, action in zip(states, actions):
+            sim.query(state, action)
+    scalar = best_time(query_all, repeat)
+    batch = best_time(lambda: sim.query_batch(states, actions), repeat)
+
+    results = {
+        "scalar_us": 1e6 * scalar / queries,
+        "scalar_per_s": queries / scalar,
+        "batch_us": 1e6 * batch / queries,
+        "batch_per_s": queries / batch,
+    }
+    print(f"Simulation.query: {results['scalar_per_s']:.0f} queries/s ({results['scalar_us']:.2f} us), "
+          f"query_batch: {results['batch_per_s']:.0f} queries/s ({results['batch_us']:.3f} us)")
+    return results
+
+def benchmark_action_latency(param_counts=(39, 61, 91, 121, 171), iterations=5000, seed=0, budget_ms=50):
+    """
+    NFQAgent.get_best_action latency per network size, mean and p99 against the control budget
+    """
+    rng = np.random.default_rng(seed)
+    states = rng.uniform(-0.5, 0.5, size=(iterations, 3))
+    results = {}
+    print(f"get_best_action latency, {iterations} calls (control budget {budget_ms} ms)")
+    for param_count in param_counts:
+        torch.manual_seed(seed)
+        agent = NFQAgent(argparse.Namespace(num_params=param_count, numpy_policy=False))
+        mean, p99 = latency_percentiles(agent.get_best_action, states)
+        results[str(param_count)] = {"mean_us": mean, "p99_us": p99}
+        print(f"\t{param_count:6d} params: mean {mean:8.2f} us, p99 {p99:8.2f} us ({100 * p99 / (1e3 * budget_ms):.3f}% of budget)")
+    return results
+
+def random_replay(n, seed=0):
+    rng = np.random.default_rng(seed)
+    replay = ReplayStore()
+    states = np.column_stack([rng.uniform(-0.7, 0.7, n), rng.uniform(-0.04, 0.04, n), rng.uniform(-1, 1, n)])
+    next_states = states + rng.normal(0, 0.01, size=(n, 3))
+    replay.extend_arrays(states, rng.integers(0, 2, size=n), rng.choice([0, 0.001, 0.002, 1], size=n), next_states, rng.random(n) < 0.01)
+    return replay
+
+def benchmark_pattern_set(sizes=(1000, 5000, 20000, 50000), num_params=171, epochs=20, seed=0, repeat=3):
+    """
+    generate_pattern_set and train (per epoch) against the number of transitions
+    """
+    results = {}
+    print(f"generate_pattern_set / train ({num_params} params, {epochs} epochs) against transitions")
+    for n in sizes:
+        torch.manual_seed(seed)
+        agent = NFQAgent(argparse.Namespace(num_params=num_params, numpy_policy=False, agent_epochs=epochs, gamma=1.0))
+        replay = random_replay(n, seed)
+
+        generate = best_time(lambda: agent.generate_pattern_set(replay), repeat)
+        pattern_set = agent.generate_pattern_set(replay)
+
+        start = time.perf_counter()
+        agent.train(pattern_set)
+        train = time.perf_counter() - start
+
+        results[str(n)] = {"generate_s": generate, "train_epoch_s": train / epochs}
+        print(f"\t{n:7d} transitions: pattern set {1e3 * generate:8.2f} ms, train {1e3 * train / epochs:8.2f} ms/epoch")
+    return results
+
+def benchmark_end_to_end(data_dir, episodes=20, seed=0):
+    """
+    Episodes per second of a full NFQMain training run (rollout, pattern set, hints, training)
+    """
+    from NFQ_main import NFQMain, get_parser
+
+    args = get_parser().parse_args(["--data_dir", data_dir, "--episodes", str(episodes), "--plots", "none"])
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = NFQMain(args).run_experiment(seed)
+    seconds = time.perf_counter() - start
+
+    results = {"seconds_s": seconds, "episodes_per_s": episodes / seconds, "steps": int(result["length"].sum())}
+    print(f"NFQMain end to end: {episodes} episodes in {seconds:.2f} s ({results['episodes_per_s']:.2f} episodes/s)")
+    return results
+
+def machine_metadata():
+    import scipy
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Timings that got slower than the baseline by more than threshold (relative).
+    Metrics ending in _per_s are throughputs (higher is better), _s and _us are times (lower is better).
+    """
+    current, base = flatten(results), flatten(baseline)
+    regressions = []
+    print(f"Comparison with baseline (regression threshold {100 * threshold:.0f}%)")
+    for name in sorted(set(current) & set(base)):
+        if name.endswith("_per_s"):
+            ratio = base[name] / current[name] if current[name] else float("inf")
+        elif name.endswith("_s") or name.endswith("_us"):
+            ratio = current[name] / base[name] if base[name] else float("inf")
+        else:
+            continue
+        regressed = ratio > 1 + threshold
+        print(f"\t{'REGRESSION' if regressed else 'ok':>10s} {name:40s} {base[name]:12.4f} -> {current[name]:12.4f}  ({ratio:.2f}x time)")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+benchmarks = ("build", "query", "simulation", "actions", "latency", "pattern_set", "end_to_end")
+
+def run_suite(args):
+    selected = benchmarks if args.bench == "all" else args.bench.split(",")
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    results = {}
+    sim = None
+    if "build" in selected:
+        results["build"] = benchmark_build(args.data_dir, cold=not args.no_cold_build)
+    if {"query", "simulation"} & set(selected):
+        sim = build_simulation(args.data_dir)
+    if "query" in selected:
+        results["query"] = benchmark_query(sim, seed=args.seed, repeat=args.repeat)
+    if "simulation" in selected:
+        results["simulation"] = {f"{name}_s": value for name, value in benchmark_compiled(sim, args.episodes, args.max_steps, args.seed).items()}
+    if "actions" in selected:
+        results["actions"] = {str(size): {f"{name}_us" if name != "numpy_mismatch" else name: value for name, value in row.items()}
+                              for size, row in benchmark_action_selection(seed=args.seed).items()}
+    if "latency" in selected:
+        results["latency"] = benchmark_action_latency(seed=args.seed)
+    if "pattern_set" in selected:
+        results["pattern_set"] = benchmark_pattern_set(seed=args.seed, repeat=args.repeat)
+    if "end_to_end" in selected:
+        results["end_to_end"] = benchmark_end_to_end(args.data_dir, args.train_episodes, args.seed)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default='./Hardware_Data', help="Directory with hardware data to build the simulation")
+    parser.add_argument("--episodes", type=int, default=100, help="Number of episodes per simulation path")
+    parser.add_argument("--max_steps", type=int, default=250, help="Number of time-steps per episode")
+    parser.add_argument("--train_episodes", type=int, default=20, help="Training episodes for the end to end benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for positions, actions and networks")
+    parser.add_argument("--bench", type=str, default="all", help=f"Comma separated, choose from: {', '.join(benchmarks)}, or all")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeats of throughput timings, the fastest is kept")
+    parser.add_argument("--no_cold_build", action="store_true", default=False, help="Skip building the simulation from the data files")
+    parser.add_argument("--output", type=str, default=None, help="Write results and machine metadata to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    report = {"metadata": machine_metadata(), "args": vars(args), "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results: {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}")
+            sys.exit(1)
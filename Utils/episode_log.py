@@ -0,0 +1,229 @@
+"""
+Append-only episode log, replaces re-pickling the whole run history on every save.
+
+A log is a folder (<name>.nfqlog) with two files:
+    data.bin     compressed frames, only ever appended to
+    index.jsonl  one line per frame: kind, episode, offset and compressed chunk lengths
+
+Each episode writes only its own delta as two frames:
+    "transitions": the new (state, action, cost, next_state, done) transitions as arrays
+    "episode":     the episode stats and the network weights
+Frames are pickled, split into chunks and the chunks are lzma compressed on a thread pool
+(lzma releases the GIL). The index gives random access to any frame: reading one episode,
+or only the transitions, never decompresses the rest.
+
+A frame is written to data.bin before its index line, and each index line is appended, flushed
+and fsynced on its own, so a save costs one line however long the run. After a crash the last line
+may be torn, or point past the end of data.bin: the reader stops before it and the log reads up to
+the last complete frame. A writer that continues an existing log first trims its index to those
+complete frames (once, temp file and rename), so new lines never follow a torn one.
+
+BackgroundEpisodeLogWriter moves pickling, compression and writing to a writer thread,
+so the training loop only pays for copying the episode's delta.
+"""
+import os
+import json
+import lzma
+import queue
+import pickle
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def experiences_to_arrays(experiences):
+    """
+    List of (state, action, cost, next_state, done) tuples -> dict of arrays
+    """
+    if len(experiences) == 0:
+        return {"states": np.zeros((0, 3)), "actions": np.zeros(0, dtype=np.int64), "costs": np.zeros(0),
+                "next_states": np.zeros((0, 3)), "dones": np.zeros(0, dtype=bool)}
+    states, actions, costs, next_states, dones = zip(*experiences)
+    return {
+        "states": np.array(states, dtype=np.float64),
+        "actions": np.array(actions, dtype=np.int64),
+        "costs": np.array(costs, dtype=np.float64),
+        "next_states": np.array(next_states, dtype=np.float64),
+        "dones": np.array(dones, dtype=bool),
+    }
+
+def arrays_to_experiences(arrays):
+    return list(zip(arrays["states"], arrays["actions"].tolist(), arrays["costs"].tolist(),
+                    arrays["next_states"], arrays["dones"].tolist()))
+
+def state_dict_to_numpy(state_dict):
+    # readers do not need torch
+    return {k: (v.detach().cpu().numpy().copy() if hasattr(v, 'detach') else np.asarray(v)) for k, v in state_dict.items()}
+
+class EpisodeLogWriter:
+    def __init__(self, path, chunk_size=1 << 20, threads=None, preset=6):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.preset = preset
+        os.makedirs(path, exist_ok=True)
+
+        self.data = open(os.path.join(path, "data.bin"), "ab")
+        self.offset = self.data.seek(0, os.SEEK_END)
+        self.index_path = os.path.join(path, "index.jsonl")
+        if os.path.exists(self.index_path):
+            # Continue an existing log: keep only its complete frames, once, so that new lines
+            # are not appended to a partly written one
+            lines = [json.dumps(e) + "\n" for e in EpisodeLogReader(path).entries]
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+        self.index = open(self.index_path, "a")
+        self.pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+
+    def compress(self, chunk):
+        return lzma.compress(chunk, preset=self.preset)
+
+    def append(self, kind, episode, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)] or [b""]
+        compressed = list(self.pool.map(self.compress, chunks))
+
+        for c in compressed:
+            self.data.write(c)
+        self.data.flush()
+        os.fsync(self.data.fileno())
+
+        entry = {"kind": kind, "episode": episode, "offset": self.offset, "chunks": [len(c) for c in compressed]}
+        # One appended line per frame, after its data is on disk (readers skip a partly written last line)
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.offset += sum(entry["chunks"])
+
+    @staticmethod
+    def snapshot(episode, new_experiences, stats, net_state):
+        """
+        Copies of everything an episode writes, safe to hand to another thread
+        """
+        return [
+            ("transitions", episode, experiences_to_arrays(new_experiences)),
+            ("episode", episode, {"epoch": episode, "episode": tuple(stats), "net_state": state_dict_to_numpy(net_state)}),
+        ]
+
+    def append_episode(self, episode, new_experiences, stats, net_state):
+        """
+        Write one episode's delta: its new transitions, its stats and the network that ran it
+        """
+        for frame in self.snapshot(episode, new_experiences, stats, net_state):
+            self.append(*frame)
+
+    def close(self):
+        self.pool.shutdown()
+        self.data.close()
+        self.index.close()
+
+class BackgroundEpisodeLogWriter:
+    """
+    Same interface as EpisodeLogWriter, the writing happens on a separate thread.
+    append_episode only takes a snapshot; if max_pending saves are still in flight it
+    blocks until one finishes (back-pressure), so a slow disk slows training down instead of growing memory.
+    """
+    def __init__(self, path, max_pending=1, **kwargs):
+        self.writer = EpisodeLogWriter(path, **kwargs)
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="episode-log-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frames = self.queue.get()
+            try:
+                if frames is None:
+                    return
+                if self.error is None:
+                    for frame in frames:
+                        self.writer.append(*frame)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError(f"Saving to {self.path} failed") from self.error
+
+    def append_episode(self, episode, new_experiences, stats, net_state):
+        self.check()
+        self.queue.put(EpisodeLogWriter.snapshot(episode, new_experiences, stats, net_state))
+
+    def flush(self):
+        """
+        Wait until every submitted episode is on disk
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        self.check()
+
+class EpisodeLogReader:
+    def __init__(self, path):
+        self.path = path
+        data_size = os.path.getsize(os.path.join(path, "data.bin"))
+
+        self.entries = []
+        with open(os.path.join(path, "index.jsonl")) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break # partially written line
+                if entry["offset"] + sum(entry["chunks"]) > data_size:
+                    break # frame was not completely written
+                self.entries.append(entry)
+
+        self.frames = {(e["kind"], e["episode"]): e for e in self.entries}
+
+    def episodes(self):
+        return [e["episode"] for e in self.entries if e["kind"] == "episode"]
+
+    def read_frame(self, entry, f=None):
+        close = f is None
+        if f is None:
+            f = open(os.path.join(self.path, "data.bin"), "rb")
+        try:
+            f.seek(entry["offset"])
+            payload = b"".join(lzma.decompress(f.read(n)) for n in entry["chunks"])
+        finally:
+            if close:
+                f.close()
+        return pickle.loads(payload)
+
+    def episode(self, episode):
+        """
+        Stats and network weights of one episode
+        """
+        return self.read_frame(self.frames[("episode", episode)])
+
+    def last(self):
+        return self.episode(self.episodes()[-1])
+
+    def transitions(self, upto=None):
+        """
+        All transitions up to (and including) episode upto, as one dict of arrays.
+        Only transition frames are decompressed.
+        """
+        entries = [e for e in self.entries if e["kind"] == "transitions" and (upto is None or e["episode"] <= upto)]
+        with open(os.path.join(self.path, "data.bin"), "rb") as f:
+            parts = [self.read_frame(e, f) for e in entries]
+        if not parts:
+            return experiences_to_arrays([])
+        return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+    def all_experiences(self, upto=None):
+        """
+        Same content as "all_experiences" of the old whole-history pickle at episode upto
+        """
+        return arrays_to_experiences(self.transitions(upto))
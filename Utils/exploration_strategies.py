@@ -14,7 +14,7 @@ def get_action_with_probability(r, remaining):
     return 0 if r < half else 1
 
 # epsilon-greedy exploration, linear decay (100% TO 5%)
-def linear_ep_greedy(nfq_agent, ep, *args):
+def linear_ep_greedy(nfq_agent, ep, episodes, *args):
     r = random.random()
 
     # Linear decay percentage
@@ -63,13 +63,13 @@ def constant_ep_greedy_ten(nfq_agent, *args):
 def no_exploration(nfq_agent, *args):
     return nfq_agent.get_best_action(*args)
 
-def exploration_strategies(nfq_agent, strategy_name, ep=None):
+def exploration_strategies(nfq_agent, strategy_name, ep=None, episodes=None):
     """
-    Returns the specified exploration strategy with the `ep` argument
+    Returns the specified exploration strategy with the `ep` (and total `episodes`) arguments
     passed only to the required functions.
     """
     strategies = {
-        'linear': partial(linear_ep_greedy, nfq_agent, ep),
+        'linear': partial(linear_ep_greedy, nfq_agent, ep, episodes),
         'exponential': partial(exponential_ep_greedy, nfq_agent, ep),
         'constant_ten': partial(constant_ep_greedy_ten, nfq_agent),
         'constant_two': partial(constant_ep_greedy_two, nfq_agent),
@@ -77,6 +77,44 @@ def exploration_strategies(nfq_agent, strategy_name, ep=None):
     }
     return strategies[strategy_name]
 
+def exploration_rate(strategy_name, ep=None, episodes=None):
+    """
+    Probability of a random action at episode ep, and the threshold below which the random action is 0
+    """
+    if strategy_name == 'linear':
+        remaining = (episodes - ep) / episodes
+    elif strategy_name == 'exponential':
+        remaining = np.exp(-0.015 * ep)
+    elif strategy_name == 'constant_ten':
+        return 0.1, 0.5 # random actions split over the whole [0, 1) range, as in get_action_with_probability(r, 1)
+    elif strategy_name == 'constant_two':
+        return 0.02, 0.5
+    elif strategy_name == 'no_exploration':
+        return 0.0, 0.0
+    else:
+        raise KeyError(strategy_name)
+    return remaining, remaining / 2
+
+def batch_explore(actions, strategy_name, ep=None, episodes=None):
+    """
+    Replace greedy actions by random ones following the strategy, each entry draws its own random number
+    """
+    eps, half = exploration_rate(strategy_name, ep, episodes)
+    if eps > 0:
+        r = np.random.random(len(actions))
+        explore = r < eps
+        actions[explore] = (r[explore] >= half).astype(actions.dtype)
+    return actions
+
+def batch_exploration_strategies(nfq_agent, strategy_name, ep=None, episodes=None):
+    """
+    Same strategies for BatchSteerboxNFQ: returns a function mapping an (N, 3) array of states to N actions.
+    """
+    def get_actions(states):
+        return batch_explore(nfq_agent.get_best_actions(states), strategy_name, ep, episodes)
+
+    return get_actions
+
 
 # Choose from
 # linear, exponential, constant_ten, constant_two, no_exploration
@@ -0,0 +1,126 @@
+"""
+Export a trained NFQNetwork as a standalone policy for the controller.
+
+From a state_dict two artifacts are written:
+    <prefix>.pt   TorchScript module, states (N, 3) -> actions (N,), loads with torch.jit.load only
+    <prefix>.npz  float32 weights for Utils.numpy_policy.NumpyQNetwork, acting needs numpy only
+
+    from Utils.numpy_policy import NumpyQNetwork
+    policy = NumpyQNetwork.load_npz("policy.npz")
+    action = policy.best_action(state)
+
+check_parity compares both artifacts against NFQAgent.get_best_action on random states.
+
+Use case:
+    python -m Utils.export_policy --log Simulation_Data/episode_[TIME]_exp0.nfqlog --out policies/policy
+    python -m Utils.export_policy --state_dict net.pt --out policies/policy
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from NFQ_model import NFQNetwork
+from Utils.numpy_policy import NumpyQNetwork
+
+class PolicyModule(nn.Module):
+    """
+    Greedy policy of an NFQNetwork, both actions evaluated in one forward pass
+    """
+    def __init__(self, net):
+        super().__init__()
+        self.layers = net.layers
+
+    def forward(self, states):
+        n = states.shape[0]
+        x = torch.zeros(2 * n, 4, dtype=states.dtype)
+        x[:n, :3] = states
+        x[n:, :3] = states
+        x[n:, 3] = 1
+        q = self.layers(x).squeeze(1)
+        # Lower Q value is better, same tie-breaking as NFQAgent.get_best_action
+        return (q[:n] >= q[n:]).long()
+
+def to_network(state_dict):
+    """
+    NFQNetwork from a state_dict (tensors or numpy arrays), size from its parameter count
+    """
+    state_dict = {k: torch.as_tensor(np.asarray(v)) for k, v in state_dict.items()}
+    net = NFQNetwork(sum(v.numel() for v in state_dict.values()))
+    net.load_state_dict(state_dict)
+    return net.eval()
+
+def export_policy(state_dict, prefix):
+    """
+    Write <prefix>.pt and <prefix>.npz, returns both paths
+    """
+    folder = os.path.dirname(prefix)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    net = to_network(state_dict)
+    script_path, npz_path = prefix + ".pt", prefix + ".npz"
+    torch.jit.script(PolicyModule(net)).save(script_path)
+    NumpyQNetwork.from_state_dict(net.state_dict()).save_npz(npz_path)
+    return script_path, npz_path
+
+def check_parity(state_dict, prefix, n=10000, seed=0):
+    """
+    Fraction of random states where the exported policies pick another action than NFQAgent.get_best_action
+    """
+    from NFQ_Agent import NFQAgent
+
+    net = to_network(state_dict)
+    agent = NFQAgent(argparse.Namespace(num_params=net.param_count, numpy_policy=False))
+    agent.load_state(net.state_dict())
+
+    rng = np.random.default_rng(seed)
+    states = np.column_stack([rng.uniform(-0.7, 0.7, n), rng.uniform(-0.04, 0.04, n), rng.uniform(-1, 1, n)]).astype(np.float32)
+    expected = np.array([agent.get_best_action(state) for state in states])
+
+    scripted = torch.jit.load(prefix + ".pt")
+    with torch.inference_mode():
+        script_actions = scripted(torch.from_numpy(states)).numpy()
+    numpy_policy = NumpyQNetwork.load_npz(prefix + ".npz")
+    numpy_actions = np.array([numpy_policy.best_action(state) for state in states])
+    numpy_batch_actions = numpy_policy.best_actions(states)
+
+    return {
+        "states": n,
+        "torchscript_mismatch": float(np.mean(script_actions != expected)),
+        "numpy_mismatch": float(np.mean(numpy_actions != expected)),
+        "numpy_batch_mismatch": float(np.mean(numpy_batch_actions != expected)),
+    }
+
+def load_state_dict(args):
+    if args.log is not None:
+        from Utils.episode_log import EpisodeLogReader
+
+        reader = EpisodeLogReader(args.log)
+        record = reader.last() if args.episode is None else reader.episode(args.episode)
+        print(f"Network of episode {record['epoch']} from {args.log}")
+        return record["net_state"]
+    return torch.load(args.state_dict, map_location="cpu")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", type=str, default=None, help="Run log (.nfqlog) to take the network from")
+    parser.add_argument("--episode", type=int, default=None, help="Episode of the run log (default: last)")
+    parser.add_argument("--state_dict", type=str, default=None, help="Or a torch.save'd NFQNetwork state_dict")
+    parser.add_argument("--out", type=str, default="./Policies/policy", help="Output prefix, writes <out>.pt and <out>.npz")
+    parser.add_argument("--tolerance", type=float, default=0.001, help="Allowed fraction of differing actions (float32 near-ties)")
+    args = parser.parse_args()
+    if (args.log is None) == (args.state_dict is None):
+        parser.error("give one of --log or --state_dict")
+
+    state_dict = load_state_dict(args)
+    paths = export_policy(state_dict, args.out)
+    print("Exported: " + ", ".join(paths))
+
+    parity = check_parity(state_dict, args.out)
+    print("Parity with NFQAgent.get_best_action: " + ", ".join(f"{k}: {v}" for k, v in parity.items()))
+    if max(v for k, v in parity.items() if k.endswith("mismatch")) > args.tolerance:
+        print("Exported policy does not match the agent")
+        sys.exit(1)
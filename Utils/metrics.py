@@ -0,0 +1,96 @@
+"""
+Episode metrics, kept up to date while training instead of recomputed from the run history.
+
+EpisodeMetrics stores the per-episode cost, success, length and loss in preallocated arrays and
+updates the moving average of the cost and the success rates in O(1) per episode.
+Plotting and reporting read these series directly.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def moving_average(r_array, num_points=30):
+    """
+    Vectorized version of the original loop in Plots, same values:
+    the first (num_points-1)/2 entries are the mean of that block, the next ones the mean of the
+    following block up to num_points-1, after that the sum of the last num_points-1 values / num_points
+    """
+    r_array = np.asarray(r_array, dtype=np.float64)
+    n = len(r_array)
+    half = int((num_points-1)/2)
+    m_avg = np.empty(n)
+
+    # Make the start full
+    m_avg[:min(n, half)] = np.mean(r_array[0:half]) if n else 0
+    if n > half:
+        m_avg[half:min(n, num_points-1)] = np.mean(r_array[half:(num_points-1)])
+    if n >= num_points:
+        m_avg[num_points-1:] = sliding_window_view(r_array, num_points-1)[1:].sum(axis=1) / num_points
+    return m_avg
+
+class EpisodeMetrics:
+    def __init__(self, episodes, num_points=30):
+        self.num_points = num_points
+        self.n = 0
+
+        self.cost = np.zeros(episodes)
+        self.success = np.zeros(episodes)
+        self.length = np.zeros(episodes)
+        self.loss = np.zeros(episodes)
+
+        # Running series
+        self.cost_avg = np.zeros(episodes) # tail of moving_average(cost), head filled in by cost_moving_average
+        self.success_rate = np.zeros(episodes) # successes so far / episodes so far
+        self.recent_success_rate = np.zeros(episodes) # over the last num_points episodes
+
+        self.window_cost = 0.0 # sum of the last num_points-1 costs
+        self.success_count = 0
+        self.recent_success_count = 0
+
+    def __len__(self):
+        return self.n
+
+    def update(self, cost, success, length, loss):
+        i = self.n
+        k = self.num_points
+        self.cost[i] = cost
+        self.success[i] = success
+        self.length[i] = length
+        self.loss[i] = loss
+
+        self.window_cost += cost
+        if i >= k-1:
+            self.window_cost -= self.cost[i-(k-1)]
+            self.cost_avg[i] = self.window_cost / k
+
+        self.success_count += success
+        self.recent_success_count += success
+        if i >= k:
+            self.recent_success_count -= self.success[i-k]
+        self.success_rate[i] = self.success_count / (i+1)
+        self.recent_success_rate[i] = self.recent_success_count / min(i+1, k)
+        self.n += 1
+
+    def cost_moving_average(self):
+        """
+        moving_average of the cost so far
+        """
+        k = self.num_points
+        m_avg = self.cost_avg[:self.n].copy()
+        m_avg[:k-1] = moving_average(self.cost[:min(self.n, k-1)], k)
+        return m_avg
+
+    def loss_percentiles(self, q=(5, 50, 95)):
+        return np.percentile(self.loss[:self.n], q) if self.n else np.full(len(q), np.nan)
+
+    def summary(self):
+        """
+        Latest values, for printing
+        """
+        i = self.n - 1
+        return {
+            "episodes": self.n,
+            "cost_avg": self.cost_moving_average()[-1] if self.n else np.nan,
+            "success_rate": self.success_rate[i] if self.n else 0.0,
+            "recent_success_rate": self.recent_success_rate[i] if self.n else 0.0,
+            "loss_percentiles": self.loss_percentiles(),
+        }
@@ -0,0 +1,96 @@
+"""
+Pure NumPy float32 evaluator for the small NFQNetwork MLPs.
+Does not import torch, the weights are plain (W, b) arrays per nn.Linear layer.
+Weights can be saved to and loaded from an .npz file (see Utils.export_policy), so a controller
+only needs numpy to act.
+"""
+import numpy as np
+
+class NumpyQNetwork:
+    """
+    Linear -> Sigmoid stack, same as NFQNetwork.
+    best_action reuses preallocated buffers, so acting allocates nothing per step.
+    """
+    def __init__(self, layers):
+        # layers: list of (weight (out, in), bias (out,)) as in nn.Linear
+        self.weights_t = [np.ascontiguousarray(np.asarray(w, dtype=np.float32).T) for w, _ in layers]
+        self.biases = [np.asarray(b, dtype=np.float32).copy() for _, b in layers]
+
+        # Input rows are (*state, 0) and (*state, 1)
+        self.action_input = np.zeros((2, self.weights_t[0].shape[0]), dtype=np.float32)
+        self.action_input[1, -1] = 1
+        self.buffers = [np.zeros((2, w.shape[1]), dtype=np.float32) for w in self.weights_t]
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        """
+        Build from an NFQNetwork state_dict (layers.0.weight, layers.0.bias, layers.2.weight, ...)
+        """
+        weights = sorted((int(k.split('.')[1]), k) for k in state_dict if k.endswith('.weight'))
+        layers = []
+        for _, k in weights:
+            w = state_dict[k]
+            b = state_dict[k[:-len('weight')] + 'bias']
+            layers.append((to_numpy(w), to_numpy(b)))
+        return cls(layers)
+
+    @classmethod
+    def load_npz(cls, path):
+        """
+        Load weights written by save_npz
+        """
+        with np.load(path) as f:
+            n_layers = int(f["n_layers"])
+            return cls([(f[f"weight_{i}"], f[f"bias_{i}"]) for i in range(n_layers)])
+
+    def save_npz(self, path):
+        # weights in nn.Linear layout (out, in)
+        arrays = {"n_layers": np.array(len(self.biases))}
+        for i, (w_t, b) in enumerate(zip(self.weights_t, self.biases)):
+            arrays[f"weight_{i}"] = w_t.T
+            arrays[f"bias_{i}"] = b
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def sigmoid_(x):
+        # in place 1 / (1 + exp(-x))
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        np.reciprocal(x, out=x)
+        return x
+
+    def forward_into(self, x, buffers):
+        for w_t, b, out in zip(self.weights_t, self.biases, buffers):
+            np.matmul(x, w_t, out=out)
+            out += b
+            x = self.sigmoid_(out)
+        return x
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for w_t, b in zip(self.weights_t, self.biases):
+            x = self.sigmoid_(x @ w_t + b)
+        return x
+
+    def best_action(self, state):
+        # Lower Q value is better, same tie-breaking as NFQAgent.get_best_action
+        self.action_input[:, :-1] = state
+        q = self.forward_into(self.action_input, self.buffers)
+        return 1 if q[0, 0] >= q[1, 0] else 0
+
+    def best_actions(self, states):
+        n = len(states)
+        x = np.empty((2 * n, self.action_input.shape[1]), dtype=np.float32)
+        x[:n, :-1] = states
+        x[n:, :-1] = states
+        x[:n, -1] = 0
+        x[n:, -1] = 1
+        q = self(x)[:, 0]
+        return (q[:n] >= q[n:]).astype(np.int64)
+
+def to_numpy(value):
+    # torch tensors without importing torch
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    return np.asarray(value, dtype=np.float32)
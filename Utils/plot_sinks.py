@@ -0,0 +1,142 @@
+"""
+Plot sinks, keep figure rendering off the training loop.
+
+Training only emits plot events, e.g. ("success", trajectory, max_steps, epoch_no), to a sink:
+    sync:     render right away in the training process (the old behavior)
+    process:  a worker process renders events in batches while training continues
+    deferred: keep the events and render them all in a worker process when the run is closed
+    none:     drop the events
+
+Only the sync sink imports matplotlib/seaborn (Utils.plots) into the training process.
+Plots can also be rendered after the fact from a run log:
+    python -m Utils.plot_sinks Simulation_Data/episode_<time>_exp0.nfqlog
+"""
+import queue
+import argparse
+import multiprocessing
+import numpy as np
+
+def render(events, plots=None):
+    """
+    Draw a list of (kind, args) events, kind is the name of a Plots.plot_<kind> method
+    """
+    if plots is None:
+        from Utils.plots import Plots
+        plots = Plots()
+    for kind, args in events:
+        getattr(plots, "plot_" + kind)(*args)
+    return plots
+
+def plot_worker(events):
+    """
+    Worker process: render whatever is queued in one batch, until None is received
+    """
+    plots = None
+    while True:
+        batch = [events.get()]
+        while True:
+            try:
+                batch.append(events.get_nowait())
+            except queue.Empty:
+                break
+        done = None in batch
+        plots = render([e for e in batch if e is not None], plots)
+        if done:
+            return
+
+class SyncPlotSink:
+    def __init__(self):
+        self.plots = None
+
+    def emit(self, kind, *args):
+        self.plots = render([(kind, args)], self.plots)
+
+    def close(self):
+        pass
+
+class NullPlotSink:
+    def emit(self, kind, *args):
+        pass
+
+    def close(self):
+        pass
+
+class ProcessPlotSink:
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self.events = context.Queue()
+        self.process = context.Process(target=plot_worker, args=(self.events,), name="plot-worker", daemon=True)
+        self.process.start()
+
+    def emit(self, kind, *args):
+        self.events.put((kind, args))
+
+    def close(self):
+        """
+        Wait until every emitted plot is rendered
+        """
+        self.events.put(None)
+        self.process.join()
+        if self.process.exitcode != 0:
+            print(f"Plot worker failed (exit code {self.process.exitcode}), some plots were not saved")
+
+class DeferredPlotSink:
+    def __init__(self):
+        self.pending = []
+
+    def emit(self, kind, *args):
+        self.pending.append((kind, args))
+
+    def close(self):
+        if not self.pending:
+            return
+        sink = ProcessPlotSink()
+        for kind, args in self.pending:
+            sink.emit(kind, *args)
+        sink.close()
+        self.pending = []
+
+plot_sinks = {
+    "sync": SyncPlotSink,
+    "process": ProcessPlotSink,
+    "deferred": DeferredPlotSink,
+    "none": NullPlotSink,
+}
+
+def make_plot_sink(name):
+    if name not in plot_sinks:
+        raise ValueError(f"Unknown plot sink {name}, choose from {', '.join(plot_sinks)}")
+    return plot_sinks[name]()
+
+def log_events(path, max_steps=250, pos_success=0.05, vel_success=0.01):
+    """
+    Plot events of a run log: a success plot per successful episode and the cost curve
+    """
+    from Utils.episode_log import EpisodeLogReader
+
+    reader = EpisodeLogReader(path)
+    episodes = reader.episodes()
+    events = []
+    with open(reader.path + "/data.bin", "rb") as f:
+        for ep in episodes:
+            if ("transitions", ep) not in reader.frames:
+                continue
+            transitions = reader.read_frame(reader.frames[("transitions", ep)], f)
+            next_states = transitions["next_states"]
+            # same success condition as SteerboxNFQ.experience
+            if len(next_states) == max_steps and abs(next_states[-1][0]) < pos_success and abs(next_states[-1][1]) < vel_success:
+                events.append(("success", (transitions["states"], max_steps, ep)))
+
+        costs = np.array([reader.read_frame(reader.frames[("episode", ep)], f)["episode"][1] for ep in episodes])
+    events.append(("cost", (costs, len(episodes))))
+    return events
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log", type=str, help="Run log (.nfqlog) to render plots from")
+    parser.add_argument("--train_max_steps", type=int, default=250, help="Episode length of the run")
+    args = parser.parse_args()
+
+    events = log_events(args.log, args.train_max_steps)
+    render(events)
+    print(f"Rendered {len(events)} plots into the Plots folder")
@@ -0,0 +1,140 @@
+"""
+Per-phase timing of the training loop.
+
+Phases of an episode (rollout, pattern set, hint-to-goal, training, run history, checkpoint) are timed with
+profiler.span(name), per-step calls (action selection, simulation query) by wrapping the function
+with profiler.wrap(name, fn). Times are summed per episode and written as one JSONL line per episode:
+    {"episode": 12, "wall": 0.41, "spans": {"rollout": {"seconds": 0.01, "count": 1}, "env_query": {...}}}
+With a chrome_path every span is also kept as an event and written as a Chrome trace
+(open in chrome://tracing or https://ui.perfetto.dev).
+
+A disabled profiler (no path) hands out a shared no-op span and returns wrapped functions unchanged,
+so the training loop pays nothing for it.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+NULL_SPAN = contextlib.nullcontext()
+
+class Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter_ns() - self.start)
+        return False
+
+class Profiler:
+    def __init__(self, path=None, chrome_path=None):
+        self.path = path
+        self.chrome_path = chrome_path
+        self.enabled = path is not None or chrome_path is not None
+
+        self.episode_spans = {} # name -> [nanoseconds, count], current episode
+        self.total_spans = {} # name -> [nanoseconds, count], whole run
+        self.events = []
+        self.episode_start = time.perf_counter_ns()
+        self.origin = self.episode_start
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+        self.file = None
+        if path is not None:
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            self.file = open(path, "w")
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def wrap(self, name, fn):
+        """
+        fn timed as a span on every call, or fn itself when disabled
+        """
+        if not self.enabled:
+            return fn
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, start, time.perf_counter_ns() - start)
+        return timed
+
+    def record(self, name, start, duration):
+        span = self.episode_spans.get(name)
+        if span is None:
+            span = self.episode_spans[name] = [0, 0]
+        span[0] += duration
+        span[1] += 1
+        if self.chrome_path is not None:
+            self.events.append((name, start, duration))
+
+    def end_episode(self, episode):
+        """
+        Write the spans of this episode and start the next one
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        record = {
+            "episode": episode,
+            "wall": (now - self.episode_start) / 1e9,
+            "spans": {name: {"seconds": ns / 1e9, "count": count} for name, (ns, count) in self.episode_spans.items()},
+        }
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+        for name, (ns, count) in self.episode_spans.items():
+            total = self.total_spans.setdefault(name, [0, 0])
+            total[0] += ns
+            total[1] += count
+        self.episode_spans = {}
+        self.episode_start = now
+
+    def summary(self):
+        """
+        Total seconds, calls and mean microseconds per call of every span over the run
+        """
+        return {name: {"seconds": ns / 1e9, "count": count, "mean_us": ns / count / 1e3}
+                for name, (ns, count) in sorted(self.total_spans.items(), key=lambda item: -item[1][0])}
+
+    def print_summary(self):
+        if not self.enabled:
+            return
+        print("Profile (whole run):")
+        for name, s in self.summary().items():
+            print(f"\t{name:>16s}: {s['seconds']:9.3f} s  {s['count']:9d} calls  {s['mean_us']:10.1f} us/call")
+
+    def write_chrome_trace(self):
+        folder = os.path.dirname(self.chrome_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        events = [{"name": name, "ph": "X", "ts": (start - self.origin) / 1e3, "dur": duration / 1e3, "pid": self.pid, "tid": self.tid}
+                  for name, start, duration in self.events]
+        with open(self.chrome_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        if self.episode_spans:
+            self.end_episode(None)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.chrome_path is not None:
+            self.write_chrome_trace()
@@ -0,0 +1,35 @@
+"""
+Merge the per-episode results of several experiments (seeds) into one table
+with the mean and a confidence band for every metric.
+"""
+import numpy as np
+from scipy import stats
+
+metrics = ("cost", "success", "length", "loss")
+
+def aggregate_runs(results, confidence=0.95):
+    """
+    results: list of dicts with one array per metric (one value per episode)
+    Returns a dict of columns: episode, then <metric>_mean, <metric>_low, <metric>_high for each metric
+    """
+    runs = len(results)
+    episodes = len(results[0]["cost"])
+    table = {"episode": np.arange(1, episodes + 1)}
+
+    # Student-t interval on the mean over runs
+    t = stats.t.ppf((1 + confidence) / 2, runs - 1) if runs > 1 else 0.0
+
+    for metric in metrics:
+        data = np.stack([np.asarray(result[metric], dtype=np.float64) for result in results])
+        mean = data.mean(axis=0)
+        sem = data.std(axis=0, ddof=1) / np.sqrt(runs) if runs > 1 else np.zeros(episodes)
+        table[f"{metric}_mean"] = mean
+        table[f"{metric}_low"] = mean - t * sem
+        table[f"{metric}_high"] = mean + t * sem
+
+    table["runs"] = np.full(episodes, runs)
+    return table
+
+def save_table(table, path):
+    columns = list(table.keys())
+    np.savetxt(path, np.column_stack([table[c] for c in columns]), delimiter=",", header=",".join(columns), comments="", fmt="%.6g")
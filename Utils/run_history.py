@@ -0,0 +1,86 @@
+"""
+Run history with a retention policy, replaces keeping a full pattern set snapshot per episode.
+
+Every episode keeps its summary: episode stats (length, cost, last loss) and the network weights.
+Pattern sets (state_action_b, target_q_values) cover every transition so far, so keeping one per
+episode grows O(episodes^2). They are kept only every pattern_every episodes, either in memory or
+spilled to .npz files in spill_dir, and the in-memory ones are bounded by max_bytes (oldest go first).
+"""
+import os
+import numpy as np
+
+class RunHistory:
+    def __init__(self, pattern_every=0, spill_dir=None, max_bytes=None):
+        self.pattern_every = pattern_every # 0 = never keep pattern sets
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+
+        self.summaries = []
+        self.patterns = {} # episode -> (state_action_b, target_q_values) in memory
+        self.spilled = {} # episode -> file
+        self.summary_bytes = 0
+        self.pattern_bytes = 0
+
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def append(self, epoch, episode, state_action_b, target_q_values, net_state):
+        net_state = {k: v.detach().cpu().numpy().copy() for k, v in net_state.items()}
+        self.summaries.append({
+            "epoch": epoch, # index
+
+            # length of episode, its total cost, and the loss of the last step
+            "episode": episode,
+
+            # the network that generated the pattern set and ran this episode
+            "net_state": net_state,
+        })
+        self.summary_bytes += sum(v.nbytes for v in net_state.values()) + 3 * 8
+
+        if self.pattern_every and epoch % self.pattern_every == 0:
+            state_action_b = np.asarray(state_action_b)
+            target_q_values = np.asarray(target_q_values)
+            if self.spill_dir is not None:
+                path = os.path.join(self.spill_dir, f"pattern_set_{epoch}.npz")
+                np.savez(path, state_action_b=state_action_b, target_q_values=target_q_values)
+                self.spilled[epoch] = path
+            else:
+                self.patterns[epoch] = (state_action_b, target_q_values)
+                self.pattern_bytes += state_action_b.nbytes + target_q_values.nbytes
+                self.enforce_budget()
+
+    def enforce_budget(self):
+        # Drop the oldest in-memory pattern sets until within budget, summaries are always kept
+        if self.max_bytes is None:
+            return
+        for epoch in sorted(self.patterns):
+            if self.nbytes() <= self.max_bytes:
+                break
+            state_action_b, target_q_values = self.patterns.pop(epoch)
+            self.pattern_bytes -= state_action_b.nbytes + target_q_values.nbytes
+
+    def nbytes(self):
+        """
+        Memory held by the history (array payloads)
+        """
+        return self.summary_bytes + self.pattern_bytes
+
+    def pattern_set(self, epoch):
+        """
+        (state_action_b, target_q_values) of an episode, or None if it was not retained
+        """
+        if epoch in self.patterns:
+            return self.patterns[epoch]
+        if epoch in self.spilled:
+            with np.load(self.spilled[epoch]) as f:
+                return f["state_action_b"], f["target_q_values"]
+        return None
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def __getitem__(self, i):
+        return self.summaries[i]
+
+    def __iter__(self):
+        return iter(self.summaries)
@@ -16,84 +16,238 @@ Contains 2 parts:
 import os 
 import lzma
 import pickle
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 from scipy.spatial import KDTree
+from concurrent.futures import ProcessPoolExecutor
+
+from Utils.episode_log import EpisodeLogReader
+
+def load_transitions(path):
+    """
+    Decode one .pickle.xz session file (or .nfqlog episode log) into (states, actions, next_states) arrays.
+    Only the last epoch is loaded: since this is real-time training data,
+    the last epoch is where the hardware agent had learned best (most of the times)
+    and its all_experiences holds every transition of the session.
+    Module level so that it can run in a process pool.
+    """
+    if path.endswith('.nfqlog'):
+        # Only the transition frames are decompressed, not the weights
+        reader = EpisodeLogReader(path)
+        t = reader.transitions()
+        if not np.all((t["actions"] == 0) | (t["actions"] == 1)):
+            raise ValueError("Action must be 0 or 1")
+        return len(reader.episodes()), t["states"].reshape(-1, 3), t["actions"], t["next_states"].reshape(-1, 3)
+
+    with lzma.open(path, "rb") as f:
+        file = pickle.load(f)
+
+    # Each experience is a tuple of (State, Action, Reward, Next State, Failed)
+    # For our transition function, we only need (State, Action, Next State)
+    experiences = file[-1]["all_experiences"]
+    states = np.array([e[0] for e in experiences], dtype=np.float64).reshape(-1, 3)
+    actions = np.array([e[1] for e in experiences], dtype=np.int64)
+    next_states = np.array([e[3] for e in experiences], dtype=np.float64).reshape(-1, 3)
+
+    if not np.all((actions == 0) | (actions == 1)):
+        raise ValueError("Action must be 0 or 1")
+    return len(file), states, actions, next_states
+
+def encode_columns(rows):
+    """
+    Dictionary encoding of an (N, 3) float64 array: (values, codes) with rows == values[codes], exactly.
+    Positions are whole encoder counts and voltages 0.1 steps, so each column only holds a few
+    thousand distinct values and the codes fit 16 bits.
+    """
+    values, codes = np.unique(rows, return_inverse=True)
+    dtype = np.uint16 if len(values) <= np.iinfo(np.uint16).max else np.uint32
+    return values, codes.reshape(rows.shape).astype(dtype)
 
 class Simulation():
     """
     Query a state and action and receive next state
     """
-    def __init__(self):
+    # Arrays persisted in the cache, everything the trees and queries need
+    cache_arrays = ("states_0", "states_1", "next_values", "next_codes")
+    # Part of the cache key, bumped when the stored arrays change
+    cache_version = 3
 
-        self.transitions_0 = []
-        self.transitions_1 = []
+    def __init__(self):
 
         self.action_zero_tree = None
         self.action_one_tree = None
 
+        # Query states per action, in the order they were recorded (the tree data)
+        self.states_0 = None
+        self.states_1 = None
+        # Next states, encoded: row i of action 0 is next_values[next_codes_0[i]], bit for bit.
+        # next_codes holds the codes of action 0 then action 1, next_codes_0/1 are views of it
+        self.next_values = None
+        self.next_codes = None
+        self.next_codes_0 = None
+        self.next_codes_1 = None
+
+        # Where the cache for the current data lives (None if not cached)
+        self.cache_path = None
+
+    # Decoded next states (copies), for code that expects the arrays
+    @property
+    def next_states(self):
+        return self.next_values[self.next_codes]
+
+    @property
+    def next_states_0(self):
+        return self.next_values[self.next_codes_0]
+
+    @property
+    def next_states_1(self):
+        return self.next_values[self.next_codes_1]
+
+    # (State, Action, Next State) tuples, kept for code that expects the old lists
+    @property
+    def transitions_0(self):
+        return [(s, 0, ns) for s, ns in zip(self.states_0, self.next_states_0)]
+
+    @property
+    def transitions_1(self):
+        return [(s, 1, ns) for s, ns in zip(self.states_1, self.next_states_1)]
+
+    @staticmethod
+    def data_files(directory):
+        return sorted(os.path.join(directory, j) for j in os.listdir(directory) if j.endswith('.pickle.xz') or j.endswith('.nfqlog'))
+
+    @staticmethod
+    def cache_key(files):
+        """
+        Hash of the source files' names, sizes and modification times
+        """
+        h = hashlib.sha256()
+        h.update(f"v{Simulation.cache_version}\n".encode())
+        for path in files:
+            # An episode log is a folder that is appended to, its files tell if it changed
+            parts = [os.path.join(path, "index.jsonl"), os.path.join(path, "data.bin")] if os.path.isdir(path) else [path]
+            for part in parts:
+                st = os.stat(part)
+                h.update(f"{os.path.basename(path)}|{os.path.basename(part)}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+        return h.hexdigest()[:16]
+
     # Build the KNN model
-    def build(self, directory):
+    def build(self, directory, cache_dir=None, use_cache=True, workers=None):
         """
         Transitions are categorized by action (0,1) first and then by state.
         This halves the query/search time.
+
+        Session files are decoded in parallel (workers processes, default all cores).
+        The extracted arrays are cached under cache_dir (default <directory>/.sim_cache)
+        and memory-mapped on the next start with the same files.
         """
-        i = 0 # file counter
         print("Building Simulation...")
+        files = self.data_files(directory)
+        if cache_dir is None:
+            cache_dir = os.path.join(directory, ".sim_cache")
+        cache_path = os.path.join(cache_dir, self.cache_key(files))
 
-        for j in os.listdir(directory):
-            print(f"File: {i+1}")
-            j = f'{directory}/{j}'
-            if j.endswith('.pickle.xz'):
-                with lzma.open(j, "rb") as f:
-                    file = pickle.load(f)
-                    print("Total Epochs: ", len(file))
-
-                    # Only load the last epoch
-                    # Since this is real-time training data, the last epoch is where the hardware agent had learned best (most of the times)
-
-                    last_item = file[-1]
-                    #print(last_item)
-                    for experience in last_item["all_experiences"]: 
-                        # Each experience is a tuple of (State, Action, Reward, Next State)
-                        # For our transition function, we only need (State, Action, Next State)
-                        #print(experience, type(experience), type(experience[0]))
-
-                        if experience[1] ==0:
-                            self.transitions_0.append((experience[0], experience[1], experience[3]))
-                        elif experience[1] ==1:
-                            self.transitions_1.append((experience[0], experience[1], experience[3]))
-                        else:
-                            raise ValueError("Action must be 0 or 1")
-                    print("Transitions added from this file: ", len(last_item["all_experiences"]))
-                    print("................................")
-            i += 1
-        print("Total Transitions Collected on Action 0:", len(self.transitions_0))
-        print("Total Transitions Collected on Action 1:", len(self.transitions_1))
+        if use_cache and os.path.exists(os.path.join(cache_path, "done")):
+            print(f"Loading cached transitions: {cache_path}")
+            for name in self.cache_arrays:
+                # np.asarray drops the memmap subclass, rows are then plain (read-only) views
+                setattr(self, name, np.asarray(np.load(os.path.join(cache_path, name + ".npy"), mmap_mode='r')))
+            self.split_next_codes()
+        else:
+            self.load_files(files, workers)
+            if use_cache:
+                self.save_cache(cache_dir, cache_path)
+
+        self.cache_path = cache_path if use_cache else None
+
+        print("Total Transitions Collected on Action 0:", len(self.states_0))
+        print("Total Transitions Collected on Action 1:", len(self.states_1))
+        print(f"Transition store: {self.nbytes() / 1e6:.2f} MB")
         print("................................")
 
-        # List of query states, TODO: shorten the code?
-        transitions_zero_query_states = np.array([item[0] for item in self.transitions_0])
-        transitions_one_query_states = np.array([item[0] for item in self.transitions_1])
-        print(f"Before tree: {transitions_zero_query_states.shape, transitions_one_query_states.shape}")
-              
         # Query trees
-        self.action_zero_tree = KDTree(transitions_zero_query_states) 
-        self.action_one_tree = KDTree(transitions_one_query_states) 
+        self.action_zero_tree = KDTree(self.states_0)
+        self.action_one_tree = KDTree(self.states_1)
         print(f"After tree: {self.action_zero_tree.data.shape, self.action_one_tree.data.shape}")
         print("................................")
 
+    def load_files(self, files, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(files)))
+
+        if workers == 1:
+            loaded = map(load_transitions, files)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            loaded = pool.map(load_transitions, files)
+
+        states, actions, next_states = [], [], []
+        for i, (path, (epochs, s, a, ns)) in enumerate(zip(files, loaded)):
+            print(f"File: {i+1} {os.path.basename(path)}")
+            print("Total Epochs: ", epochs)
+            print("Transitions added from this file: ", len(s))
+            print("................................")
+            states.append(s)
+            actions.append(a)
+            next_states.append(ns)
+
+        if workers > 1:
+            pool.shutdown()
+
+        states = np.concatenate(states) if states else np.zeros((0, 3))
+        actions = np.concatenate(actions) if actions else np.zeros(0, dtype=np.int64)
+        next_states = np.concatenate(next_states) if next_states else np.zeros((0, 3))
+
+        # The trees are built over the float64 states in recorded order, so neighbours (and ties) are
+        # the same as with the plain per-action arrays. Only the next states are stored encoded
+        self.states_0, self.states_1 = states[actions == 0], states[actions == 1]
+        self.next_values, self.next_codes = encode_columns(np.concatenate([next_states[actions == 0], next_states[actions == 1]]))
+        self.split_next_codes()
+
+    def split_next_codes(self):
+        n = len(self.states_0)
+        self.next_codes_0 = self.next_codes[:n]
+        self.next_codes_1 = self.next_codes[n:]
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.cache_arrays)
+
+    def save_cache(self, cache_dir, cache_path):
+        """
+        Write the arrays to a temporary folder and rename it into place, so a
+        killed build never leaves a half written cache behind. Stale entries are removed.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+        os.chmod(tmp_path, 0o755)
+        for name in self.cache_arrays:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+        open(os.path.join(tmp_path, "done"), "w").close()
+
+        for entry in os.listdir(cache_dir):
+            if not entry.startswith(".tmp_"):
+                shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Another process got there first, with the same content
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
     # Query the KNN model
     def query(self, state, action):
         if action == 0:
             # The index returned here is index of transitions zero
             dist, ind = self.action_zero_tree.query(state, k=1)
             #print("distance to neighbor:", dist )
-            next_state = self.transitions_0[ind][2]
+            next_state = self.next_values[self.next_codes_0[ind]]
         
         elif action == 1:
             dist, ind = self.action_one_tree.query(state, k=1) 
             #print("distance to neighbor:", dist )
-            next_state = self.transitions_1[ind][2]
+            next_state = self.next_values[self.next_codes_1[ind]]
 
         else:
             raise ValueError("Action must be 0 or 1")
@@ -101,6 +255,139 @@ class Simulation():
 
         return next_state
 
+    # Query the KNN model for many states at once
+    def query_batch(self, states, actions):
+        """
+        Batched version of query: states is (N, 3), actions is (N,) of 0/1.
+        One tree query is made per action group, returns next states as (N, 3).
+        """
+        states = np.asarray(states, dtype=np.float64)
+        actions = np.asarray(actions)
+        next_states = np.empty((len(states), 3))
+
+        zero = actions == 0
+        one = actions == 1
+        if not np.all(zero | one):
+            raise ValueError("Action must be 0 or 1")
+
+        if zero.any():
+            _, ind = self.action_zero_tree.query(states[zero], k=1)
+            next_states[zero] = self.next_values[self.next_codes_0[ind]]
+        if one.any():
+            _, ind = self.action_one_tree.query(states[one], k=1)
+            next_states[one] = self.next_values[self.next_codes_1[ind]]
+
+        return next_states
+
+class CompiledSimulation():
+    """
+    Integer lookup table over a built Simulation.
+
+    After the first step every state is (pos, vel) of some stored next state plus a voltage
+    that moves in 0.1 steps clipped to [-1, 1]. Both sets are finite, so the nearest neighbor
+    of every reachable (row, voltage, action) can be precomputed and rollouts become array lookups.
+    The first step from an arbitrary reset position still goes through the trees.
+
+    Rows index next_states, which stacks the next states of action 0 then action 1.
+    Voltages are the exact floats SteerboxEnv produces (0.1 + 0.1 + 0.1 != 0.3), so results are
+    bit-identical to Simulation.query.
+    """
+    def __init__(self, sim, use_cache=True):
+        self.sim = sim
+        self.use_cache = use_cache
+        self.offset_1 = len(sim.states_0)
+        self.next_states = sim.next_states
+
+        # Every voltage reachable from 0 by the same float ops as SteerboxEnv.step
+        self.voltages, self.next_voltage = self.enumerate_voltages()
+        self.voltage_index = {v: i for i, v in enumerate(self.voltages.tolist())}
+        self.zero_voltage = self.voltage_index[0.0]
+
+        # (row, voltage index, action) -> next row, -1 until computed
+        # A fully precomputed table is kept next to the simulation cache and memory-mapped
+        table_path = self.table_path()
+        if table_path is not None and os.path.exists(table_path):
+            self.table = np.load(table_path, mmap_mode='r')
+        else:
+            self.table = np.full((len(self.next_states), len(self.voltages), 2), -1, dtype=np.int32)
+
+    def table_path(self):
+        if self.sim.cache_path is None or not self.use_cache:
+            return None
+        return os.path.join(self.sim.cache_path, "table.npy")
+
+    @staticmethod
+    def enumerate_voltages():
+        seen = {0.0: 0}
+        voltages = [0.0]
+        edges = []
+        i = 0
+        while i < len(voltages):
+            v = voltages[i]
+            row = []
+            for dv in (-0.1, 0.1):
+                w = float(max(-1, min(1, v + dv)))
+                if w not in seen:
+                    seen[w] = len(voltages)
+                    voltages.append(w)
+                row.append(seen[w])
+            edges.append(row)
+            i += 1
+        return np.array(voltages), np.array(edges, dtype=np.int64)
+
+    def query_rows(self, states, actions, workers=1):
+        """
+        Tree query for arbitrary (N, 3) states, returns rows of next_states
+        """
+        states = np.asarray(states, dtype=np.float64)
+        actions = np.asarray(actions)
+        rows = np.empty(len(states), dtype=np.int64)
+
+        zero = actions == 0
+        one = actions == 1
+        if not np.all(zero | one):
+            raise ValueError("Action must be 0 or 1")
+
+        if zero.any():
+            _, rows[zero] = self.sim.action_zero_tree.query(states[zero], k=1, workers=workers)
+        if one.any():
+            _, ind = self.sim.action_one_tree.query(states[one], k=1, workers=workers)
+            rows[one] = ind + self.offset_1
+        return rows
+
+    def fill(self, rows, voltage_ids, actions, workers=1):
+        """
+        Compute the table entries for the given keys (duplicates are fine)
+        """
+        states = np.empty((len(rows), 3))
+        states[:, :2] = self.next_states[rows, :2]
+        states[:, 2] = self.voltages[voltage_ids]
+        self.table[rows, voltage_ids, actions] = self.query_rows(states, actions, workers)
+
+    def precompute(self, chunk=1000000, workers=-1):
+        """
+        Fill the whole table (all cores by default). Without this, entries are filled lazily on first use.
+        """
+        keys = np.flatnonzero(self.table.ravel() < 0)
+        for start in range(0, len(keys), chunk):
+            rows, voltage_ids, actions = np.unravel_index(keys[start:start+chunk], self.table.shape)
+            self.fill(rows, voltage_ids, actions, workers)
+
+        table_path = self.table_path()
+        if len(keys) and table_path is not None:
+            tmp_path = table_path + ".tmp.npy"
+            np.save(tmp_path, self.table)
+            os.replace(tmp_path, table_path)
+
+    def next_rows(self, rows, voltage_ids, actions):
+        actions = np.asarray(actions)
+        next_rows = self.table[rows, voltage_ids, actions]
+        missing = next_rows < 0
+        if missing.any():
+            self.fill(rows[missing], voltage_ids[missing], actions[missing])
+            next_rows = self.table[rows, voltage_ids, actions]
+        return next_rows
+
 # Use case:
 # sim = Simulation()
 # sim.build('./Data')